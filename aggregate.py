@@ -0,0 +1,155 @@
+"""
+Streaming statistics of cohort outcomes.
+
+A CohortStatistics takes the final virus population of one patient (or a batch
+of them) at a time and keeps only running aggregates: the number of patients,
+the number cured, the mean and variance (Welford's algorithm), the minimum and
+maximum and a fixed-bin histogram, from which quantiles are approximated. Its
+size does not depend on the cohort size, and two aggregates of the same arm,
+e.g. from different worker processes, merge into one with merge().
+"""
+
+import numpy
+
+
+class CohortStatistics(object):
+    """
+    Running summary of the final populations of one treatment arm.
+    """
+
+    def __init__(self, edges, cureThreshold=50):
+        """
+        edges: the histogram bin edges (an increasing sequence of numbers).
+        Populations outside them are counted in the first or last bin.
+
+        cureThreshold: a patient is counted as cured when its final population
+        is at most this value (an integer)
+        """
+        self.edges = numpy.asarray(edges, dtype=float)
+        self.cureThreshold = cureThreshold
+        self.histogram = numpy.zeros(len(self.edges) - 1, dtype=numpy.int64)
+        self.count = 0
+        self.curedCount = 0
+        self.mean = 0.0
+        self.sumSquares = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def add(self, finalPops):
+        """
+        Adds the outcome of one or more patients.
+
+        finalPops: a final total virus population (an integer), or an array of
+        them
+        """
+        values = numpy.atleast_1d(numpy.asarray(finalPops, dtype=float))
+        if len(values) == 0:
+            return
+        batch = CohortStatistics(self.edges, self.cureThreshold)
+        batch.count = len(values)
+        batch.curedCount = int(numpy.count_nonzero(
+            values <= self.cureThreshold))
+        batch.mean = float(values.mean())
+        batch.sumSquares = float(((values - batch.mean) ** 2).sum())
+        batch.minimum = float(values.min())
+        batch.maximum = float(values.max())
+        clipped = numpy.clip(values, self.edges[0], self.edges[-1])
+        batch.histogram = numpy.histogram(clipped, self.edges)[0]
+        self.merge(batch)
+
+    def merge(self, other):
+        """
+        Folds another summary of the same arm into this one, as if its
+        patients had been added here.
+
+        other: a CohortStatistics with the same edges and cureThreshold
+        """
+        if not numpy.array_equal(self.edges, other.edges) or \
+                self.cureThreshold != other.cureThreshold:
+            raise ValueError('only statistics with the same bins and cure '
+                             'threshold can be merged')
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.sumSquares += other.sumSquares + \
+                           delta * delta * self.count * other.count / count
+        self.mean += delta * other.count / count
+        self.count = count
+        self.curedCount += other.curedCount
+        self.histogram = self.histogram + other.histogram
+        if self.minimum is None or other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if self.maximum is None or other.maximum > self.maximum:
+            self.maximum = other.maximum
+
+    def getCount(self):
+        """
+        returns: the number of patients added (an integer)
+        """
+        return self.count
+
+    def getCureRate(self):
+        """
+        returns: the fraction of cured patients (a float)
+        """
+        if self.count == 0:
+            return 0.0
+        return float(self.curedCount) / self.count
+
+    def getMean(self):
+        """
+        returns: the mean final population (a float)
+        """
+        return self.mean
+
+    def getVariance(self):
+        """
+        returns: the sample variance of the final populations (a float)
+        """
+        if self.count < 2:
+            return 0.0
+        return self.sumSquares / (self.count - 1)
+
+    def getQuantile(self, quantile):
+        """
+        Approximates a quantile of the final populations by interpolating
+        linearly within the histogram bin it falls in, so it is accurate to
+        about one bin width. Quantiles 0 and 1 are the exact minimum and
+        maximum.
+
+        quantile: which quantile (a float between 0-1)
+
+        returns: the approximate quantile (a float)
+        """
+        if self.count == 0:
+            raise ValueError('no patients to take a quantile of')
+        if quantile <= 0:
+            return self.minimum
+        if quantile >= 1:
+            return self.maximum
+        target = quantile * self.count
+        cumulative = numpy.cumsum(self.histogram)
+        i = min(int(numpy.searchsorted(cumulative, target)),
+                len(self.histogram) - 1)
+        before = cumulative[i - 1] if i else 0
+        inBin = self.histogram[i]
+        fraction = (target - before) / inBin if inBin else 0.0
+        low, high = self.edges[i], self.edges[i + 1]
+        value = low + fraction * (high - low)
+        return float(min(max(value, self.minimum), self.maximum))
+
+    def getHistogram(self):
+        """
+        returns: a (counts, edges) tuple, as numpy.histogram() returns them
+        """
+        return self.histogram.copy(), self.edges.copy()
+
+
+def forScenario(scenario, bins=50):
+    """
+    returns: an empty CohortStatistics for an arm, with bins equal-width bins
+    from 0 to the arm's maxPop and its cure threshold
+    """
+    return CohortStatistics(numpy.linspace(0, scenario.maxPop, bins + 1),
+                            scenario.cureThreshold)
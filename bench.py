@@ -0,0 +1,361 @@
+"""
+Benchmarks for the simulation hot paths.
+
+Each benchmark Case times one path of ps12 on a problem2/problem4/problem5
+style setup:
+
+- 'SimplePatient.update': untreated SimpleVirus population (problem2)
+- 'Patient.update': untreated ResistantVirus population on a given engine
+  (problem4 before the prescription)
+- 'ResistantVirus.reproduce': reproduce() calls at half density by a particle
+  resisting the prescribed drug, which is passed as the prescription mask,
+  as Patient.update() passes it
+- 'Patient.getResistPop': resistance queries for every single drug and for
+  all drugs combined (problem4/problem7), each set of queries timed right
+  after an untimed update(), so that none of them is answered from the cache
+- 'cohort': a problem5-style cohort, either one patient at a time or as a
+  PatientBatch, without early stopping so that every patient-step is
+  simulated
+
+Patient populations start at maxPop / 2, the neighbourhood of the plateau, so
+the timed steps reflect steady-state cost rather than the growth phase.
+Results report steps/sec, particles/sec and the peak traced memory, and can be
+saved to JSON and compared against a stored baseline. Particles are not
+counted for resistance queries, which read per-genotype counts rather than
+particles, nor for cohorts, whose populations are not observed:
+
+    python bench.py --preset quick --output results.json --baseline base.json
+"""
+
+import argparse
+import itertools
+import json
+import sys
+import time
+import tracemalloc
+
+import cohort
+import ps12
+
+
+DRUG_NAMES = ['guttagonol', 'gimpex']
+
+PRESETS = {
+    'quick': {'maxPops': [1000, 10000], 'drugCounts': [1, 2],
+              'mutProbs': [0.005], 'cohortSizes': [10, 100],
+              'steps': 5},
+    'full': {'maxPops': [1000, 10000, 100000, 1000000],
+             'drugCounts': [1, 2, 4, 8], 'mutProbs': [0.005, 0.05],
+             'cohortSizes': [10, 100, 1000], 'steps': 5},
+}
+
+
+def drugNames(number):
+    """
+    returns: number drug names, starting with the ones used by the problem
+    drivers (a list of strings)
+    """
+    names = DRUG_NAMES[:number]
+    return names + ['drug%d' % j for j in range(len(names), number)]
+
+
+class Case(object):
+    """
+    One benchmark: a hot path and the parameters it is timed at.
+    """
+
+    def __init__(self, path, engine='object', maxPop=1000, drugs=1,
+                 mutProb=0.005, patients=1, steps=5):
+        """
+        path: the hot path to time, one of the paths listed in the module
+        docstring (a string)
+
+        engine: the patient implementation, one of cohort.ENGINES, or 'batch'
+        for the cohort path (a string)
+
+        maxPop: the maximum virus population (an integer)
+
+        drugs: the number of drugs the viruses track (an integer)
+
+        mutProb: the mutation probability (a float)
+
+        patients: the cohort size, only used by the cohort path (an integer)
+
+        steps: how many time steps (or repetitions for the per-call paths)
+        are timed (an integer)
+        """
+        self.path = path
+        self.engine = engine
+        self.maxPop = maxPop
+        self.drugs = drugs
+        self.mutProb = mutProb
+        self.patients = patients
+        self.steps = steps
+
+    def getName(self):
+        """
+        returns: a stable name identifying the case in result files (a string)
+        """
+        return '%s[engine=%s,maxPop=%d,drugs=%d,mutProb=%g,patients=%d]' % (
+            self.path, self.engine, self.maxPop, self.drugs, self.mutProb,
+            self.patients)
+
+    def makeScenario(self):
+        """
+        returns: the problem5-style cohort.Scenario of this case, treated with
+        the first drug half way through. Cured patients are not
+        fast-forwarded, so every step is simulated.
+        """
+        engine = self.engine if self.engine != 'batch' else 'genotype'
+        return cohort.Scenario(self.steps, {self.steps // 2: drugNames(1)},
+                               drugs=drugNames(self.drugs),
+                               mutProb=self.mutProb, maxPop=self.maxPop,
+                               engine=engine, earlyStop=False)
+
+    def makePatient(self):
+        """
+        returns: a patient of this case's engine at half its maximum
+        population
+        """
+        scenario = self.makeScenario()
+        scenario.initialViruses = self.maxPop // 2
+        if self.path == 'SimplePatient.update':
+            viruses = [ps12.SimpleVirus(scenario.maxBirthProb,
+                                        scenario.clearProb)
+                       for x in range(scenario.initialViruses)]
+            return ps12.SimplePatient(viruses, self.maxPop, rng=0)
+        return scenario.makePatient(ps12.makeGenerator(0))
+
+
+def _prepare(case):
+    """
+    Builds everything a case needs outside of the timed region.
+
+    returns: a callable running the case once and returning a (seconds, steps,
+    particles) tuple: the time spent in the timed part, the number of steps
+    (or calls) it covered and the number of particles they processed (None
+    when not measured)
+    """
+    if case.path == 'cohort':
+        scenario = case.makeScenario()
+
+        def run():
+            start = time.perf_counter()
+            if case.engine == 'batch':
+                cohort.runBatch(scenario, case.patients, seed=0)
+            else:
+                cohort.runCohort(scenario, case.patients, seed=0, processes=1)
+            return (time.perf_counter() - start, case.steps * case.patients,
+                    None)
+        return run
+    if case.path == 'ResistantVirus.reproduce':
+        scenario = case.makeScenario()
+        virus = ps12.ResistantVirus(
+            scenario.maxBirthProb, scenario.clearProb,
+            dict((drug, True) for drug in scenario.drugs), scenario.mutProb)
+        prescriptionMask = ps12.DRUGS.getMask(drugNames(1))
+        rand = ps12.makeUniform(0)
+        calls = case.steps * case.maxPop
+
+        def run():
+            start = time.perf_counter()
+            for x in range(calls):
+                try:
+                    virus.reproduce(0.5, prescriptionMask, rand)
+                except ps12.NoChildException:
+                    pass
+            return time.perf_counter() - start, calls, calls
+        return run
+    patient = case.makePatient()
+    if case.path == 'Patient.getResistPop':
+        queries = [[drug] for drug in drugNames(case.drugs)]
+        queries.append(drugNames(case.drugs))
+
+        def run():
+            seconds = 0.0
+            for x in range(case.steps):
+                # update() empties the resistance cache, and is not timed
+                patient.update()
+                start = time.perf_counter()
+                for drugs in queries:
+                    patient.getResistPop(drugs)
+                seconds += time.perf_counter() - start
+            return seconds, case.steps * len(queries), None
+        return run
+
+    def run():
+        particles = 0
+        start = time.perf_counter()
+        for x in range(case.steps):
+            particles += patient.getTotalPop()
+            patient.update()
+        return time.perf_counter() - start, case.steps, particles
+    return run
+
+
+def timeCase(case, repeat=3):
+    """
+    Times a case, keeping the fastest of repeat runs, then measures its peak
+    memory in a separate traced run (tracing slows allocation down, so it is
+    kept out of the timings). Every run starts from a freshly built patient;
+    building it is traced but not timed.
+
+    returns: a dictionary of results for the case
+    """
+    best = None
+    for x in range(repeat):
+        seconds, steps, particles = _prepare(case)()
+        if best is None or seconds < best[0]:
+            best = (seconds, steps, particles)
+    seconds, steps, particles = best
+    tracemalloc.start()
+    try:
+        _prepare(case)()
+        peakMemory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'name': case.getName(),
+            'path': case.path,
+            'engine': case.engine,
+            'maxPop': case.maxPop,
+            'drugs': case.drugs,
+            'mutProb': case.mutProb,
+            'patients': case.patients,
+            'seconds': seconds,
+            'stepsPerSec': steps / seconds,
+            'particlesPerSec': (particles / seconds
+                                if particles is not None else None),
+            'peakMemory': peakMemory}
+
+
+def makeGrid(maxPops, drugCounts, mutProbs, cohortSizes, steps=5,
+             engines=('object', 'compact', 'array', 'genotype')):
+    """
+    Builds the cross product of benchmark cases.
+
+    maxPops, drugCounts, mutProbs, cohortSizes: the values of each axis
+    (sequences)
+
+    steps: how many steps each case times (an integer)
+
+    engines: the patient engines timed on the Patient paths (a sequence of
+    strings)
+
+    returns: a list of Case instances
+    """
+    cases = []
+    for maxPop in maxPops:
+        cases.append(Case('SimplePatient.update', maxPop=maxPop, drugs=0,
+                          steps=steps))
+        cases.append(Case('ResistantVirus.reproduce', maxPop=maxPop,
+                          steps=steps))
+    for maxPop, drugs, mutProb in itertools.product(maxPops, drugCounts,
+                                                    mutProbs):
+        for engine in engines:
+            for path in ('Patient.update', 'Patient.getResistPop'):
+                cases.append(Case(path, engine, maxPop, drugs, mutProb,
+                                  steps=steps))
+    for patients, drugs in itertools.product(cohortSizes, drugCounts):
+        for engine in ('genotype', 'batch'):
+            cases.append(Case('cohort', engine, drugs=drugs,
+                              patients=patients, steps=steps * 30))
+    return cases
+
+
+def runSuite(cases, repeat=3, out=sys.stdout):
+    """
+    Times every case, printing one line per case as it completes.
+
+    returns: the list of result dictionaries
+    """
+    results = []
+    for case in cases:
+        result = timeCase(case, repeat)
+        results.append(result)
+        if out is not None:
+            particles = result['particlesPerSec']
+            print('%-90s %12.1f steps/s %14s particles/s %10.1f MiB'
+                  % (result['name'], result['stepsPerSec'],
+                     '-' if particles is None else '%.0f' % particles,
+                     result['peakMemory'] / 2.0 ** 20), file=out)
+    return results
+
+
+def saveResults(results, path):
+    """
+    Saves benchmark results to a JSON file.
+    """
+    with open(path, 'w') as resultFile:
+        json.dump({'python': sys.version, 'results': results}, resultFile,
+                  indent=1)
+
+
+def loadResults(path):
+    """
+    returns: the list of result dictionaries saved at path
+    """
+    with open(path) as resultFile:
+        return json.load(resultFile)['results']
+
+
+def compareResults(results, baseline, tolerance=0.1):
+    """
+    Compares throughput against a baseline, case by case.
+
+    results, baseline: lists of result dictionaries
+
+    tolerance: the relative slowdown tolerated before a case counts as a
+    regression (a float)
+
+    returns: a list of (name, speedup, regressed) tuples, where speedup is the
+    ratio of steps/sec to the baseline's, for the cases present in both
+    """
+    previous = dict((result['name'], result) for result in baseline)
+    comparison = []
+    for result in results:
+        if result['name'] not in previous:
+            continue
+        speedup = result['stepsPerSec'] / previous[result['name']]['stepsPerSec']
+        comparison.append((result['name'], speedup,
+                           speedup < 1 - tolerance))
+    return comparison
+
+
+def main(argv=None):
+    """
+    Command line entry point, see the module docstring.
+
+    returns: the process exit status (1 when a case regressed against the
+    baseline)
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--preset', choices=sorted(PRESETS), default='quick')
+    parser.add_argument('--path', action='append',
+                        help='only time this hot path (repeatable)')
+    parser.add_argument('--engine', action='append',
+                        help='only time this engine (repeatable)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+    cases = makeGrid(**PRESETS[args.preset])
+    if args.path:
+        cases = [case for case in cases if case.path in args.path]
+    if args.engine:
+        cases = [case for case in cases if case.engine in args.engine]
+    results = runSuite(cases, args.repeat)
+    if args.output:
+        saveResults(results, args.output)
+    status = 0
+    if args.baseline:
+        for name, speedup, regressed in compareResults(
+                results, loadResults(args.baseline), args.tolerance):
+            print('%-90s %6.2fx%s' % (name, speedup,
+                                      '  REGRESSION' if regressed else ''))
+            status = status or int(regressed)
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,777 @@
+"""
+Cohort runner for problem5/problem6-style trials.
+
+A Scenario describes one treatment arm (strain parameters, maxPop, drug
+schedule and number of time steps). runCohort() simulates a number of
+independent patients of that scenario across a process pool and returns their
+final virus populations and cure flags as arrays. Every patient gets its own
+seed spawned from the cohort seed, so a cohort is reproducible regardless of
+how many worker processes run it. runBatch() instead advances a whole cohort
+in one process as a single ps12.PatientBatch. runBranched() simulates several
+arms that differ only in when treatment starts, forking every patient's
+untreated history at each arm's first prescription instead of re-simulating
+it per arm. runAdaptive() keeps adding patients to an arm until its cure rate
+(and optionally final population quantiles) are known to a requested
+precision. runComparison() simulates the same patients under several arms
+with common random numbers and reports paired differences between them.
+runStreaming() only keeps running statistics of an arm (see aggregate), so
+its memory does not grow with the cohort size.
+"""
+
+import math
+import multiprocessing
+import statistics
+
+import numpy
+
+import aggregate
+import ps12
+
+
+ENGINES = {
+    'object': ps12.Patient,
+    'compact': ps12.Patient,
+    'array': ps12.ArrayPatient,
+    'genotype': ps12.GenotypePatient,
+    'hybrid': ps12.HybridPatient,
+}
+
+
+class Scenario(object):
+    """
+    Representation of one treatment arm of a cohort trial.
+    """
+
+    def __init__(self, steps, schedule=None, drugs=('guttagonol',),
+                 maxBirthProb=0.1, clearProb=0.05, mutProb=0.005,
+                 initialViruses=100, maxPop=1000, cureThreshold=50,
+                 engine='object', earlyStop=True, steadyWindow=None):
+        """
+        Initialize a Scenario instance, saves all parameters as attributes of
+        the instance.
+
+        steps: the number of time steps each patient is simulated for (an
+        integer)
+
+        schedule: a dictionary mapping a time step (an integer) to the list of
+        drug names prescribed right before that step is simulated. No drugs are
+        given when omitted.
+
+        drugs: the drugs the viruses track resistance to (a sequence of
+        strings). Every initial virus starts resistant to none of them.
+
+        maxBirthProb, clearProb, mutProb: the strain parameters of every
+        initial virus (floats between 0-1)
+
+        initialViruses: the number of viruses injected into each patient (an
+        integer)
+
+        maxPop: the maximum virus population of each patient (an integer)
+
+        cureThreshold: a patient is counted as cured when its final population
+        is at most this value (an integer)
+
+        engine: which patient implementation simulates the arm, one of the keys
+        of ENGINES (a string)
+
+        earlyStop: whether patients that can no longer reproduce are
+        fast-forwarded to the end of the run (a boolean, see simulate())
+
+        steadyWindow: if given, untreated-from-here-on runs stop once steady
+        over windows of this many steps (an integer, see simulate())
+        """
+        if engine not in ENGINES:
+            raise ValueError('unknown engine %r, expected one of %s'
+                             % (engine, sorted(ENGINES)))
+        self.steps = steps
+        self.schedule = dict(schedule or {})
+        self.drugs = tuple(drugs)
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.mutProb = mutProb
+        self.initialViruses = initialViruses
+        self.maxPop = maxPop
+        self.cureThreshold = cureThreshold
+        self.engine = engine
+        self.earlyStop = earlyStop
+        self.steadyWindow = steadyWindow
+
+    def getParameters(self):
+        """
+        returns: every parameter of this scenario as a JSON-serializable
+        dictionary, with the schedule as a sorted list of [step, drugs] pairs;
+        Scenario(**parameters) rebuilds the scenario (after turning the
+        schedule back into a dictionary)
+        """
+        return {'steps': self.steps,
+                'schedule': [[step, list(self.schedule[step])]
+                             for step in sorted(self.schedule)],
+                'drugs': list(self.drugs),
+                'maxBirthProb': self.maxBirthProb,
+                'clearProb': self.clearProb,
+                'mutProb': self.mutProb,
+                'initialViruses': self.initialViruses,
+                'maxPop': self.maxPop,
+                'cureThreshold': self.cureThreshold,
+                'engine': self.engine,
+                'earlyStop': self.earlyStop,
+                'steadyWindow': self.steadyWindow}
+
+    def makeViruses(self):
+        """
+        returns: the initial virus population of one patient (a list of
+        ResistantVirus instances, or CompactVirus instances sharing one Strain
+        for the compact engine)
+        """
+        if self.engine == 'compact':
+            strain = ps12.Strain(self.maxBirthProb, self.clearProb,
+                                 self.drugs, self.mutProb)
+            return strain.makeViruses(self.initialViruses)
+        viruses = []
+        for x in range(self.initialViruses):
+            resistances = dict((drug, False) for drug in self.drugs)
+            viruses.append(ps12.ResistantVirus(self.maxBirthProb,
+                                               self.clearProb,
+                                               resistances,
+                                               self.mutProb))
+        return viruses
+
+    def makePatient(self, rng):
+        """
+        Builds a freshly infected patient for this scenario.
+
+        rng: the random generator of this patient (a numpy.random.Generator)
+
+        returns: a Patient (or engine subclass) instance
+        """
+        return ENGINES[self.engine](self.makeViruses(), self.maxPop, rng=rng)
+
+    def simulate(self, patient, recorder=None, patientId=0, start=0,
+                 profiler=None, coupling=None):
+        """
+        Runs a patient through every time step of this scenario, applying the
+        drug schedule on the way. A PatientBatch is advanced the same way.
+
+        recorder: if given, the patient's state is written to it after every
+        time step (a recorder.TrajectoryRecorder)
+
+        patientId: the id the patient is recorded (and profiled) under (an
+        integer)
+
+        start: the number of time steps the patient has already been through,
+        e.g. when resuming from a ps12.loadCheckpoint() or continuing a fork
+        (an integer). Drugs scheduled before it are prescribed right away.
+
+        profiler: if given, it is attached to the patient for the run, which
+        then reports the timing and events of every update() to it (a
+        recorder.PhaseProfiler)
+
+        coupling: if given, the patient is reseeded before every time step
+        from this seed and the step (a numpy.random.SeedSequence, see
+        keyedGenerator()). Simulations of the same patient under different
+        arms then draw the same numbers at the same step, so they only drift
+        apart where the treatments differ.
+
+        Unless something is recorded or profiled, the run is shortened where
+        that cannot change its outcome. With earlyStop, a patient whose
+        population can no longer reproduce (extinct, or every particle
+        blocked by a prescribed drug) is fast-forwarded to the end in one
+        draw. Drugs are never withdrawn, so this state is absorbing. Patients
+        that can advance() several steps at once (HybridPatient) go from one
+        prescription to the next in one call. With steadyWindow, the run ends
+        once no drug is left to prescribe and the total population of the
+        last two windows of that many steps agree within sampling error. That
+        stop is approximate: a population still creeping up to its plateau
+        can pass the test early, so steadyWindow is off by default and longer
+        windows are safer.
+
+        returns: the final total virus population (an integer, or an array of
+        integers for a PatientBatch)
+        """
+        shortcuts = recorder is None and profiler is None
+        if profiler is not None:
+            patient.setProfiler(profiler, patientId)
+        leaping = shortcuts and coupling is None and \
+                  hasattr(patient, 'advance')
+        events = sorted(self.schedule)
+        history = []
+        for event in events:
+            if event < start:
+                for drug in self.schedule[event]:
+                    patient.addPrescription(drug)
+        step = start
+        while step < self.steps:
+            for drug in self.schedule.get(step, ()):
+                patient.addPrescription(drug)
+            if coupling is not None:
+                patient.reseed(keyedGenerator(coupling, step))
+            if shortcuts and self.earlyStop and \
+                    numpy.all(patient.isBlocked()):
+                for event in events:
+                    if step < event < self.steps:
+                        for drug in self.schedule[event]:
+                            patient.addPrescription(drug)
+                patient.fastForward(self.steps - step)
+                break
+            if leaping:
+                following = [event for event in events if event > step]
+                nextStep = min(following + [self.steps])
+                patient.advance(nextStep - step)
+                step = nextStep
+                continue
+            total = patient.update()
+            if recorder is not None:
+                recorder.record(patient, step, patientId)
+            step += 1
+            if shortcuts and self.steadyWindow and \
+                    not [event for event in events if event >= step]:
+                history.append(numpy.asarray(total, dtype=float))
+                if self._isSteady(history):
+                    break
+        return patient.getTotalPop()
+
+    def _isSteady(self, history):
+        """
+        history: the total population after each step since the last
+        prescription (a list of numbers or arrays)
+
+        returns: True once the last two windows of steadyWindow steps have
+        means within two standard errors of each other (for every patient of
+        a batch)
+        """
+        window = self.steadyWindow
+        if len(history) < 2 * window:
+            return False
+        earlier = numpy.array(history[-2 * window:-window])
+        later = numpy.array(history[-window:])
+        difference = numpy.abs(earlier.mean(axis=0) - later.mean(axis=0))
+        error = numpy.sqrt((earlier.var(axis=0) + later.var(axis=0)) / window)
+        return bool(numpy.all(difference <= 2 * error))
+
+    def getFirstTreatment(self):
+        """
+        returns: the time step of the first prescription, or the number of
+        steps when nothing is prescribed (an integer)
+        """
+        return min([step for step in self.schedule if step < self.steps] +
+                   [self.steps])
+
+    def getStrain(self):
+        """
+        returns: everything that determines an untreated patient of this arm
+        (a tuple); arms with equal strains can share untreated histories
+        """
+        return (self.engine, self.drugs, self.maxBirthProb, self.clearProb,
+                self.mutProb, self.initialViruses, self.maxPop)
+
+
+def delayedTreatment(delay, **kwargs):
+    """
+    returns: the problem5 scenario, guttagonol given after delay time steps
+    followed by an additional 150 time steps.
+    """
+    return Scenario(delay + 150, {delay: ['guttagonol']},
+                    drugs=('guttagonol',), **kwargs)
+
+
+def twoDrugTreatment(firstDelay, secondDelay, **kwargs):
+    """
+    returns: the problem6 scenario, guttagonol given after firstDelay time
+    steps, gimpex secondDelay time steps later, followed by an additional 150
+    time steps.
+    """
+    schedule = {}
+    schedule.setdefault(firstDelay, []).append('guttagonol')
+    schedule.setdefault(firstDelay + secondDelay, []).append('gimpex')
+    return Scenario(firstDelay + secondDelay + 150, schedule,
+                    drugs=('guttagonol', 'gimpex'), **kwargs)
+
+
+class CohortResult(object):
+    """
+    Outcome of a cohort run: one entry per patient, in patient order.
+    """
+
+    def __init__(self, scenario, seed, finalPops):
+        """
+        scenario: the Scenario that was simulated
+
+        seed: the entropy of the cohort seed (an integer); passing it back to
+        runCohort() reproduces the cohort
+
+        finalPops: the final total virus population of each patient (a
+        sequence of integers)
+        """
+        self.scenario = scenario
+        self.seed = seed
+        self.finalPops = numpy.asarray(finalPops, dtype=numpy.int64)
+        self.cured = self.finalPops <= scenario.cureThreshold
+
+    def getNumberOfPatients(self):
+        """
+        returns: the number of simulated patients (an integer)
+        """
+        return len(self.finalPops)
+
+    def getCureRate(self):
+        """
+        returns: the fraction of cured patients (a float)
+        """
+        if len(self.cured) == 0:
+            return 0.0
+        return float(numpy.count_nonzero(self.cured)) / len(self.cured)
+
+    def getCureInterval(self, confidence=0.95):
+        """
+        Wilson score interval of the cure rate, which stays meaningful for
+        cure rates near 0 or 1, where most arms are.
+
+        confidence: the coverage of the interval (a float between 0-1)
+
+        returns: a (low, high) tuple of floats
+        """
+        n = self.getNumberOfPatients()
+        if n == 0:
+            return 0.0, 1.0
+        z = _normalQuantile(confidence)
+        p = self.getCureRate()
+        scale = 1 + z * z / n
+        center = (p + z * z / (2 * n)) / scale
+        half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / scale
+        return max(center - half, 0.0), min(center + half, 1.0)
+
+    def getQuantileInterval(self, quantile, confidence=0.95):
+        """
+        Distribution-free interval of a quantile of the final populations,
+        between the order statistics whose ranks bracket n * quantile by z
+        binomial standard deviations.
+
+        quantile: which quantile (a float between 0-1, e.g. 0.5 for the
+        median)
+
+        confidence: the coverage of the interval (a float between 0-1)
+
+        returns: a (low, high) tuple of final populations
+        """
+        n = self.getNumberOfPatients()
+        if n == 0:
+            raise ValueError('no patients to take a quantile of')
+        z = _normalQuantile(confidence)
+        spread = z * math.sqrt(n * quantile * (1 - quantile))
+        low = max(int(math.floor(n * quantile - spread)), 0)
+        high = min(int(math.ceil(n * quantile + spread)), n - 1)
+        ordered = numpy.sort(self.finalPops)
+        return int(ordered[low]), int(ordered[high])
+
+
+def _normalQuantile(confidence):
+    """
+    returns: the z value of a two-sided normal interval with the given
+    coverage (a float)
+    """
+    return statistics.NormalDist().inv_cdf(0.5 + confidence / 2.0)
+
+
+def _runPatient(job):
+    """
+    Pool worker: simulates a single patient.
+
+    job: a (scenario, seedSequence) tuple
+
+    returns: the patient's final total virus population (an integer)
+    """
+    scenario, seedSequence = job
+    rng = numpy.random.default_rng(seedSequence)
+    return scenario.simulate(scenario.makePatient(rng))
+
+
+def _runBranches(job):
+    """
+    Pool worker: simulates one patient under several treatment arms, forking
+    its untreated history at each arm's first prescription.
+
+    job: a (scenarios, seedSequence) tuple
+
+    returns: the patient's final total virus population under each scenario
+    (a list of integers)
+    """
+    scenarios, seedSequence = job
+    rng = numpy.random.default_rng(seedSequence)
+    trunk = scenarios[0].makePatient(rng)
+    order = sorted(range(len(scenarios)),
+                   key=lambda i: scenarios[i].getFirstTreatment())
+    finalPops = [None] * len(scenarios)
+    step = 0
+    for i in order:
+        branchStep = scenarios[i].getFirstTreatment()
+        if hasattr(trunk, 'advance'):
+            trunk.advance(branchStep - step)
+        else:
+            for x in range(branchStep - step):
+                trunk.update()
+        step = branchStep
+        finalPops[i] = scenarios[i].simulate(trunk.fork(), start=step)
+    return finalPops
+
+
+def keyedGenerator(seedSequence, step):
+    """
+    returns: the generator of one time step of a patient (a
+    numpy.random.Generator), derived from the patient's seed and the step
+    alone, so every arm simulating that patient gets the same one
+    """
+    return numpy.random.default_rng(numpy.random.SeedSequence(
+        seedSequence.entropy, spawn_key=seedSequence.spawn_key + (step,)))
+
+
+def _runCoupled(job):
+    """
+    Pool worker: simulates one patient under every arm of a comparison.
+
+    job: a (scenarios, seedSequence, coupled) tuple. Coupled arms share the
+    patient's seed and are reseeded per step from it; otherwise every arm
+    gets its own seed spawned from it.
+
+    returns: the patient's final total virus population under each scenario
+    (a list of integers)
+    """
+    scenarios, seedSequence, coupled = job
+    finalPops = []
+    if coupled:
+        for scenario in scenarios:
+            patient = scenario.makePatient(
+                numpy.random.default_rng(seedSequence))
+            finalPops.append(scenario.simulate(patient,
+                                               coupling=seedSequence))
+    else:
+        for scenario, armSeed in zip(scenarios,
+                                     seedSequence.spawn(len(scenarios))):
+            patient = scenario.makePatient(numpy.random.default_rng(armSeed))
+            finalPops.append(scenario.simulate(patient))
+    return finalPops
+
+
+def patientSeeds(seed, numberOfPatients):
+    """
+    Spawns one independent seed per patient from a cohort seed.
+
+    seed: the cohort seed (an integer, or None for fresh entropy)
+
+    returns: a (cohortEntropy, seedSequences) tuple
+    """
+    root = numpy.random.SeedSequence(seed)
+    return root.entropy, root.spawn(numberOfPatients)
+
+
+def runCohort(scenario, numberOfPatients, seed=None, processes=None,
+              chunksize=None):
+    """
+    Simulates numberOfPatients independent patients of a scenario across a
+    process pool.
+
+    scenario: the treatment arm to simulate (a Scenario)
+
+    numberOfPatients: the cohort size (an integer)
+
+    seed: the cohort seed (an integer). Patient i always receives the i-th
+    seed spawned from it, so results do not depend on processes or chunksize.
+    Fresh entropy is drawn when omitted and recorded on the result.
+
+    processes: the number of worker processes (an integer). Defaults to the
+    number of CPUs; 1 runs every patient in the calling process.
+
+    chunksize: how many patients are handed to a worker at a time (an
+    integer). Defaults to an even split into a few chunks per worker.
+
+    Neither this nor the other pool runners can record trajectories: a
+    recorder.TrajectoryRecorder appends to one open file in the calling
+    process, which the workers cannot share. To record a cohort, run its
+    patients through Scenario.simulate() one at a time, or use runBatch().
+
+    returns: a CohortResult
+    """
+    entropy, seeds = patientSeeds(seed, numberOfPatients)
+    jobs = [(scenario, s) for s in seeds]
+    finalPops = _mapJobs(_runPatient, jobs, processes, chunksize)
+    return CohortResult(scenario, entropy, finalPops)
+
+
+def _mapJobs(worker, jobs, processes=None, chunksize=None):
+    """
+    Runs worker over jobs across a process pool (see runCohort() for
+    processes and chunksize), in the calling process when processes is 1.
+
+    returns: the list of results, in job order
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1 or len(jobs) <= 1:
+        return [worker(job) for job in jobs]
+    if chunksize is None:
+        chunksize = max(1, len(jobs) // (processes * 4))
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(worker, jobs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def runBranched(scenarios, numberOfPatients, seed=None, processes=None,
+                chunksize=None):
+    """
+    Simulates numberOfPatients patients under every one of several treatment
+    arms, e.g. the problem5 delays. Each patient's untreated history is
+    simulated once, up to the latest first prescription, and forked at every
+    arm's first prescription; each fork then continues on its own random
+    draws. The untreated part of a delay sweep so costs one run instead of
+    one per arm.
+
+    Every arm on its own samples the same distribution as runCohort(), but
+    the arms are not independent of each other: a patient's outcomes share
+    its untreated history across arms (which sharpens comparisons between
+    arms rather than biasing them).
+
+    scenarios: the arms to simulate (a list of Scenario instances with equal
+    getStrain())
+
+    numberOfPatients, seed, processes, chunksize: as for runCohort()
+
+    returns: a list of CohortResult instances, one per scenario
+    """
+    scenarios = list(scenarios)
+    for scenario in scenarios[1:]:
+        if scenario.getStrain() != scenarios[0].getStrain():
+            raise ValueError('runBranched() needs arms that only differ in '
+                             'their treatment')
+    entropy, seeds = patientSeeds(seed, numberOfPatients)
+    jobs = [(scenarios, s) for s in seeds]
+    finalPops = numpy.array(_mapJobs(_runBranches, jobs, processes,
+                                     chunksize), dtype=numpy.int64)
+    finalPops = finalPops.reshape(numberOfPatients, len(scenarios))
+    return [CohortResult(scenario, entropy, finalPops[:, i])
+            for i, scenario in enumerate(scenarios)]
+
+
+def runAdaptive(scenario, width=0.05, quantiles=(), quantileWidth=None,
+                confidence=0.95, batchSize=100, maxPatients=10000, seed=None,
+                processes=None):
+    """
+    Simulates patients of a scenario in batches until the confidence
+    intervals of its cure rate, and of the requested final population
+    quantiles, are narrow enough. Arms with a cure rate near 0 or 1 stop
+    after a few hundred patients; arms near 1/2 need the most.
+
+    width: the widest cure rate interval accepted (a float)
+
+    quantiles: the final population quantiles whose intervals must also be
+    narrow (a sequence of floats between 0-1)
+
+    quantileWidth: the widest quantile interval accepted (a number of
+    viruses); required when quantiles are given
+
+    confidence: the coverage of every interval (a float between 0-1)
+
+    batchSize: the number of patients added at a time, each batch spread
+    over the process pool (an integer)
+
+    maxPatients: stop there even if the intervals are still too wide (an
+    integer)
+
+    seed, processes: as for runCohort(). Patient i gets the same seed as in
+    runCohort(), so the first n patients match runCohort(scenario, n, seed).
+
+    returns: a CohortResult; its getNumberOfPatients() is how many patients
+    the arm needed
+    """
+    if quantiles and quantileWidth is None:
+        raise ValueError('quantileWidth is needed to stop on quantiles')
+    root = numpy.random.SeedSequence(seed)
+    finalPops = []
+    while True:
+        number = min(batchSize, maxPatients - len(finalPops))
+        jobs = [(scenario, s) for s in root.spawn(number)]
+        finalPops.extend(_mapJobs(_runPatient, jobs, processes))
+        result = CohortResult(scenario, root.entropy, finalPops)
+        if len(finalPops) >= maxPatients:
+            return result
+        low, high = result.getCureInterval(confidence)
+        precise = high - low <= width
+        for quantile in quantiles:
+            low, high = result.getQuantileInterval(quantile, confidence)
+            precise = precise and high - low <= quantileWidth
+        if precise:
+            return result
+
+
+class Comparison(object):
+    """
+    Outcome of a comparison of treatment arms on the same patients: patient i
+    of every arm is the same simulated patient, so arms can be compared
+    patient by patient.
+    """
+
+    def __init__(self, results, coupled):
+        """
+        results: one CohortResult per arm, in arm order, with patients in the
+        same order
+
+        coupled: whether the arms were run with common random numbers (a
+        boolean)
+        """
+        self.results = results
+        self.coupled = coupled
+
+    def _outcomes(self, arm, statistic):
+        result = self.results[arm]
+        if statistic == 'cured':
+            return result.cured.astype(float)
+        if statistic == 'finalPops':
+            return result.finalPops.astype(float)
+        raise ValueError("statistic must be 'cured' or 'finalPops'")
+
+    def getPairedDifference(self, arm, baseline=0, statistic='cured'):
+        """
+        Estimates how much an arm differs from a baseline arm.
+
+        arm, baseline: indices of the arms compared
+
+        statistic: 'cured' for the difference in cure rate, 'finalPops' for
+        the difference in mean final population
+
+        returns: a (difference, pairedError, independentError) tuple: the mean
+        difference, its standard error from the patient-by-patient
+        differences, and the standard error it would have if the arms had
+        been simulated independently
+        """
+        outcomes = self._outcomes(arm, statistic)
+        reference = self._outcomes(baseline, statistic)
+        n = len(outcomes)
+        differences = outcomes - reference
+        pairedError = math.sqrt(differences.var(ddof=1) / n)
+        independentError = math.sqrt((outcomes.var(ddof=1) +
+                                      reference.var(ddof=1)) / n)
+        return float(differences.mean()), pairedError, independentError
+
+    def getVarianceReduction(self, arm, baseline=0, statistic='cured'):
+        """
+        returns: the factor by which pairing reduces the variance of the
+        difference between two arms (a float, infinite when the paired
+        differences do not vary). It is about how many times more patients
+        independent arms would need for the same precision.
+        """
+        difference, pairedError, independentError = \
+            self.getPairedDifference(arm, baseline, statistic)
+        if pairedError == 0:
+            return float('inf') if independentError else 1.0
+        return (independentError / pairedError) ** 2
+
+
+def runComparison(scenarios, numberOfPatients, seed=None, coupled=True,
+                  processes=None, chunksize=None):
+    """
+    Simulates the same patients under several treatment arms, e.g. the
+    problem5 delays or problem6 lags, and pairs them up for comparison.
+
+    With coupled, arms use common random numbers: every patient's random
+    source is reseeded at each time step from the patient's seed and the
+    step (see Scenario.simulate()), so until the treatments differ the arms
+    follow the exact same trajectory, and afterwards they keep drawing the
+    same numbers for the same step. Patient-to-patient variation then largely
+    cancels out of the differences between arms. Each arm on its own still
+    samples the same distribution as runCohort().
+
+    scenarios: the arms to compare (a list of Scenario instances)
+
+    numberOfPatients, seed, processes, chunksize: as for runCohort()
+
+    coupled: whether to use common random numbers (a boolean); independent
+    arms are useful as a reference
+
+    returns: a Comparison
+    """
+    scenarios = list(scenarios)
+    entropy, seeds = patientSeeds(seed, numberOfPatients)
+    jobs = [(scenarios, s, coupled) for s in seeds]
+    finalPops = numpy.array(_mapJobs(_runCoupled, jobs, processes, chunksize),
+                            dtype=numpy.int64)
+    finalPops = finalPops.reshape(numberOfPatients, len(scenarios))
+    return Comparison([CohortResult(scenario, entropy, finalPops[:, i])
+                       for i, scenario in enumerate(scenarios)], coupled)
+
+
+def _runStatistics(job):
+    """
+    Pool worker: simulates a chunk of patients, keeping only their summary.
+
+    job: a (scenario, seedSequences, bins) tuple, bins as for
+    runStreaming()
+
+    returns: the chunk's own aggregate.CohortStatistics
+    """
+    scenario, seeds, bins = job
+    statistics = aggregate.forScenario(scenario, bins)
+    for seedSequence in seeds:
+        statistics.add(_runPatient((scenario, seedSequence)))
+    return statistics
+
+
+def runStreaming(scenario, numberOfPatients, seed=None, processes=None,
+                 chunksize=None, bins=50):
+    """
+    Simulates numberOfPatients patients of a scenario like runCohort(), but
+    returns running statistics instead of every final population. Each worker
+    summarizes its chunk of patients, discarding every patient as soon as it
+    has run, and the summaries are merged.
+
+    scenario, numberOfPatients, seed, processes, chunksize: as for
+    runCohort()
+
+    bins: the number of histogram bins between 0 and maxPop (an integer)
+
+    returns: an aggregate.CohortStatistics
+    """
+    entropy, seeds = patientSeeds(seed, numberOfPatients)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if chunksize is None:
+        chunksize = max(1, numberOfPatients // (processes * 4))
+    jobs = [(scenario, seeds[i:i + chunksize], bins)
+            for i in range(0, numberOfPatients, chunksize)]
+    statistics = aggregate.forScenario(scenario, bins)
+    for chunk in _mapJobs(_runStatistics, jobs, processes, 1):
+        statistics.merge(chunk)
+    return statistics
+
+
+def runBatch(scenario, numberOfPatients, seed=None, recorder=None,
+             profiler=None):
+    """
+    Simulates numberOfPatients patients of a scenario in the calling process,
+    advancing all of them together as one ps12.PatientBatch. This ignores
+    scenario.engine and is exact for the genotype model; it pays off for
+    cohorts where per-patient interpreter overhead dominates (small maxPop).
+
+    scenario: the treatment arm to simulate (a Scenario)
+
+    numberOfPatients: the cohort size (an integer)
+
+    seed: the cohort seed (an integer). Fresh entropy is drawn when omitted
+    and recorded on the result. Batched and per-patient runs of the same seed
+    sample the same distribution but not the same trajectories.
+
+    recorder: if given, every patient's state is written to it after every
+    time step (a recorder.TrajectoryRecorder)
+
+    profiler: if given, the timing and events of every time step are
+    reported to it, one row per patient (a recorder.PhaseProfiler)
+
+    returns: a CohortResult
+    """
+    root = numpy.random.SeedSequence(seed)
+    batch = ps12.PatientBatch(scenario.makeViruses(), scenario.maxPop,
+                              numberOfPatients,
+                              rng=numpy.random.default_rng(root))
+    return CohortResult(scenario, root.entropy,
+                        scenario.simulate(batch, recorder,
+                                          profiler=profiler))
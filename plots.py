@@ -0,0 +1,87 @@
+"""
+Plotting layer for the problem drivers in ps12.
+
+Importing this module imports matplotlib, so the simulation core never does:
+the drivers import it lazily, right before they plot.
+"""
+
+import matplotlib.pyplot as plt
+
+
+def plotTimeSeries(series, title=None, xlabel='Time steps',
+                   ylabel='virus population', grid=True, show=True):
+    """
+    Plots one or more populations as a function of time on a new figure.
+
+    series: a list of (values, label) pairs, one line each. values is the
+    population at every time step (a sequence of numbers); label names the line
+    in the legend (a string, or None to leave the figure without a legend).
+
+    title, xlabel, ylabel: the figure texts (strings); no title when omitted
+
+    grid: whether to draw the grid (a boolean)
+
+    show: whether to block on plt.show() (a boolean)
+
+    returns: the matplotlib Figure
+    """
+    figure = plt.figure()
+    labelled = False
+    for values, label in series:
+        plt.plot(list(range(0, len(values))), values, label=label)
+        labelled = labelled or label is not None
+    if labelled:
+        plt.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
+                   ncol=2, mode="expand", borderaxespad=0.)
+    if title is not None:
+        plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    if grid:
+        plt.grid()
+    if show:
+        plt.show()
+    return figure
+
+
+def plotHistogram(values, title, xlabel, ylabel='Total patients', show=True,
+                  bins=10, weights=None):
+    """
+    Plots a histogram of final virus populations on a new figure.
+
+    values: the final total virus population of every patient (a sequence of
+    integers)
+
+    bins: the number of bins, or their edges (as taken by plt.hist)
+
+    weights: how many patients each value stands for (a sequence of numbers,
+    e.g. the counts of a precomputed histogram with values at its left
+    edges); one each when omitted
+
+    title, xlabel, ylabel: the figure texts (strings)
+
+    show: whether to block on plt.show() (a boolean)
+
+    returns: the matplotlib Figure
+    """
+    figure = plt.figure()
+    plt.hist(values, bins=bins, weights=weights)
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel(ylabel)
+    if show:
+        plt.show()
+    return figure
+
+
+def saveFigure(figure, path):
+    """
+    Writes a figure to an image file and closes it, so that rendering many
+    figures in one process does not keep them all open.
+
+    figure: the matplotlib Figure, as returned by the plot functions
+
+    path: the file to write, its format taken from the extension (a string)
+    """
+    figure.savefig(path)
+    plt.close(figure)
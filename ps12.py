@@ -1,8 +1,18 @@
+import aggregate
+import argparse
 import numpy
 import random
-import pylab
-import matplotlib.pyplot as plt
+import recorder
 import collections
+import contextlib
+import copy
+import functools
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import time
 
 class NoChildException(Exception):
     """
@@ -12,6 +22,365 @@ class NoChildException(Exception):
     modify/add any code.
     """    
 
+#
+# RANDOM STREAMS
+#
+
+class RandomStream(object):
+    """
+    Seedable source of uniform random numbers for the per-particle paths of
+    the object model. Uniforms are generated in blocks by a NumPy Generator and
+    handed out one at a time through random(), which (like random.random) is a
+    C-level callable, so a draw costs no Python frame.
+
+    A stream can be copied and pickled; the copy continues with exactly the
+    uniforms the original would have handed out next.
+    """
+
+    def __init__(self, seed=None, blockSize=4096):
+        """
+        seed: an integer, a numpy.random.SeedSequence or a
+        numpy.random.Generator. Fresh entropy is drawn when omitted.
+
+        blockSize: the number of uniforms generated at a time (an integer)
+        """
+        if isinstance(seed, numpy.random.Generator):
+            self.rng = seed
+        else:
+            if not isinstance(seed, numpy.random.SeedSequence):
+                seed = numpy.random.SeedSequence(seed)
+            self.rng = numpy.random.default_rng(seed)
+        self.blockSize = blockSize
+        self._start([])
+
+    def _start(self, pending):
+        """
+        (Re)builds random(), which first hands out the uniforms in pending (a
+        list of floats) and then fresh blocks.
+        """
+        self.pending = iter(pending)
+        self.random = functools.partial(
+            next, itertools.chain.from_iterable(self._blocks()))
+
+    def _blocks(self):
+        """
+        Yields the pending uniforms, then blocks of uniforms in [0, 1) forever
+        (iterators over lists of floats). self.pending always refers to the
+        block being handed out.
+        """
+        yield self.pending
+        while True:
+            self.pending = iter(self.rng.random(self.blockSize).tolist())
+            yield self.pending
+
+    def __getstate__(self):
+        # copying the iterator leaves the one random() reads from untouched
+        return {'rng': self.rng, 'blockSize': self.blockSize,
+                'pending': list(copy.copy(self.pending))}
+
+    def __setstate__(self, state):
+        self.rng = state['rng']
+        self.blockSize = state['blockSize']
+        self._start(state['pending'])
+
+    def spawn(self, number):
+        """
+        Derives independent child streams, e.g. one per patient of a cohort.
+
+        number: how many streams to spawn (an integer)
+
+        returns: a list of RandomStream instances
+        """
+        seedSequence = self.rng.bit_generator.seed_seq
+        return [RandomStream(child, self.blockSize)
+                for child in seedSequence.spawn(number)]
+
+
+def makeGenerator(rng):
+    """
+    returns: the numpy.random.Generator behind rng, which may be None (fresh
+    entropy), a seed, a SeedSequence, a Generator or a RandomStream.
+    """
+    if isinstance(rng, RandomStream):
+        return rng.rng
+    if isinstance(rng, numpy.random.Generator):
+        return rng
+    return numpy.random.default_rng(rng)
+
+
+def makeStream(rng):
+    """
+    returns: the RandomStream drawing from rng (as accepted by makeGenerator),
+    or None when rng is None (the module-level random generator).
+    """
+    if rng is None or isinstance(rng, RandomStream):
+        return rng
+    return RandomStream(makeGenerator(rng))
+
+
+def makeUniform(rng):
+    """
+    returns: a zero-argument callable drawing uniforms in [0, 1) from rng (as
+    accepted by makeGenerator), or random.random when rng is None.
+    """
+    stream = makeStream(rng)
+    if stream is None:
+        return random.random
+    return stream.random
+
+
+def spawnRandom(rng):
+    """
+    Derives one independent child of a random source. Successive calls on the
+    same source give different children, in a reproducible order.
+
+    rng: a RandomStream, a numpy.random.Generator, or None
+
+    returns: a new source of the same kind (None for None)
+    """
+    if rng is None:
+        return None
+    return rng.spawn(1)[0]
+
+#
+# CHECKPOINTS
+#
+
+class Checkpointable(object):
+    """
+    Snapshots, forks and on-disk checkpoints for the patient classes.
+
+    Copies are cheap: they share everything that is only ever replaced, never
+    changed in place (virus particles and NumPy arrays), and copy the
+    containers update() and addPrescription() modify (see _detach()). So a
+    copy costs about one list or dictionary copy, not a copy of every
+    particle.
+
+    Subclasses name the attribute holding their random source in
+    randomAttribute and rebuild whatever depends on it in _setRandom().
+    """
+
+    randomAttribute = 'rng'
+
+    def _detach(self):
+        """
+        Replaces the containers this instance modifies in place by copies, so
+        that it no longer shares them with the instance it was copied from.
+        """
+
+    def _setRandom(self, rng):
+        """
+        rng: the new random source (anything accepted by makeGenerator)
+        """
+        self.rng = makeGenerator(rng)
+
+    def _copy(self, rng):
+        """
+        returns: a detached shallow copy of this instance drawing from rng
+        """
+        clone = copy.copy(self)
+        clone._detach()
+        clone._setRandom(rng)
+        return clone
+
+    def snapshot(self):
+        """
+        Takes an independent copy of this patient, random state included.
+        Continuing the snapshot reproduces exactly what continuing this
+        patient would (unless it draws from the module-level random
+        generator, which the copy shares).
+
+        returns: the copy
+        """
+        return self._copy(copy.deepcopy(getattr(self, self.randomAttribute)))
+
+    def reseed(self, rng):
+        """
+        Switches this patient to another random source, e.g. one keyed by the
+        time step to couple several simulations of the same patient.
+
+        rng: anything accepted by makeGenerator
+        """
+        self._setRandom(rng)
+
+    def fork(self, rng=None):
+        """
+        Branches this patient: the copy starts from the current state but goes
+        on with its own random draws, e.g. to try another treatment on the
+        same untreated history.
+
+        rng: the random source of the branch (anything accepted by
+        makeGenerator). Defaults to a child spawned from this patient's
+        source (see spawnRandom()), so repeated forks differ.
+
+        returns: the copy
+        """
+        if rng is None:
+            rng = spawnRandom(getattr(self, self.randomAttribute))
+        return self._copy(rng)
+
+    def save(self, path):
+        """
+        Writes this patient, random state included, to a file that
+        loadCheckpoint() reads back, so that a long run can resume from it.
+
+        path: the file name (a string)
+        """
+        with open(path, 'wb') as checkpointFile:
+            pickle.dump(self, checkpointFile, pickle.HIGHEST_PROTOCOL)
+
+
+def loadCheckpoint(path):
+    """
+    returns: the patient saved at path by Checkpointable.save()
+    """
+    with open(path, 'rb') as checkpointFile:
+        return pickle.load(checkpointFile)
+
+#
+# PROFILING
+#
+
+class Instrumented(object):
+    """
+    Opt-in instrumentation of update() for the patient classes. Once a
+    profiler is attached, every update() reports the wall time of each of its
+    phases (clearance, density, gating, reproduction, mutation, extension) and
+    the number of clear, birth and mutation events to
+    profiler.addStep(patientId, times, counts), see recorder.PhaseProfiler.
+
+    Without a profiler, update() pays one attribute test per step (the
+    object-model patients) or a few calls to int() (the array engines,
+    through _clock), never per-particle work.
+    """
+
+    profiler = None
+    profileId = 0
+    _clock = staticmethod(int)
+
+    def setProfiler(self, profiler, patientId=0):
+        """
+        Attaches a profiler to this patient, or detaches it.
+
+        profiler: where update() reports to (a recorder.PhaseProfiler, or
+        None to switch instrumentation off)
+
+        patientId: the id this patient is reported under (an integer)
+        """
+        self.profiler = profiler
+        self.profileId = patientId
+        self._clock = time.perf_counter_ns if profiler is not None else int
+
+    def __getstate__(self):
+        # profilers hold open files; a restored patient starts unprofiled
+        state = self.__dict__.copy()
+        for name in ('profiler', 'profileId', '_clock'):
+            state.pop(name, None)
+        return state
+
+#
+# DRUG REGISTRY
+#
+
+class DrugRegistry(object):
+    """
+    Assigns every drug its own bit, in the order drugs are first seen, so a
+    set of drugs is a single integer mask. Resistances and prescriptions are
+    both kept as masks, and "resistant to every prescribed drug" is one
+    bitwise test: prescribed & ~resistant == 0.
+    """
+
+    def __init__(self, drugNames=()):
+        """
+        drugNames: drugs to register right away (a sequence of strings)
+        """
+        self.bits = {}
+        for drug in drugNames:
+            self.getBit(drug)
+
+    def getBit(self, drug):
+        """
+        returns: the bit of a drug (an integer power of two), assigning the
+        next free one to a drug seen for the first time
+        """
+        try:
+            return self.bits[drug]
+        except KeyError:
+            bit = self.bits[drug] = 1 << len(self.bits)
+            return bit
+
+    def getMask(self, drugs):
+        """
+        returns: the mask of a collection of drug names (an integer)
+        """
+        mask = 0
+        for drug in drugs:
+            mask |= self.getBit(drug)
+        return mask
+
+    def getDrugs(self, mask):
+        """
+        returns: the drugs whose bits are set in mask, in registration order
+        (a list of strings)
+        """
+        return [drug for drug in self.bits if mask & self.bits[drug]]
+
+
+# The registry every ResistantVirus, Strain and Patient of this process
+# shares. Masks are only meaningful within one process: pickled viruses and
+# patients store drug names and rebuild their masks when loaded.
+DRUGS = DrugRegistry()
+
+#
+# PRESCRIPTIONS
+#
+
+class Treatable(object):
+    """
+    The prescriptions of a patient: the drug names in the order they were
+    given (drugs) and their mask in DRUGS (prescriptionMask). Shared by every
+    patient class that takes drugs, whatever its virus population is stored
+    as; the class provides getResistPop().
+    """
+
+    def __setstate__(self, state):
+        # masks are only valid in the process that built them
+        self.__dict__.update(state)
+        self.prescriptionMask = DRUGS.getMask(self.drugs)
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient. After a prescription is added, the 
+        drug acts on the virus population for all subsequent time steps. If the
+        newDrug is already prescribed to this patient, the method has no effect.
+
+        newDrug: The name of the drug to administer to the patient (a string).
+
+        postcondition: list of drugs being administered to a patient is updated
+        """
+        bit = DRUGS.getBit(newDrug)
+        if not self.prescriptionMask & bit:
+            self.drugs.append(newDrug)
+            self.prescriptionMask |= bit
+
+    def getPrescriptions(self):
+        """
+        Returns the drugs that are being administered to this patient.
+
+        returns: The list of drug names (strings) being administered to this
+        patient.
+        """
+        return self.drugs
+
+    def isBlocked(self):
+        """
+        Tells whether no virus particle can reproduce any more, i.e. none is
+        resistant to every prescribed drug (see SimplePatient.isBlocked()).
+
+        returns: True if the population can no longer grow, otherwise False
+        """
+        return self.getResistPop(self.getPrescriptions()) == 0
+
 #
 # PROBLEM 1
 #
@@ -20,6 +389,8 @@ class SimpleVirus(object):
     """
     Representation of a simple virus (does not model drug effects/resistance).
     """
+
+    __slots__ = ('maxBirthProb', 'clearProb')
     
     def __init__(self, maxBirthProb, clearProb):
         """
@@ -33,21 +404,26 @@ class SimpleVirus(object):
         self.maxBirthProb = float(maxBirthProb)
         self.clearProb = float(clearProb)
         
-    def doesClear(self):
+    def doesClear(self, rand=None):
         """
         Stochastically determines whether this virus is cleared from the
         patient's body at a time step. 
 
+        rand: the source of uniform random numbers (a zero-argument callable).
+        Defaults to random.random.
+
         returns: Using a random number generator (random.random()), this method
         returns True with probability self.clearProb and otherwise returns
         False.
         """
-        if random.random() <= self.clearProb:
+        if rand is None:
+            rand = random.random
+        if rand() <= self.clearProb:
             return True
         else:
             return False
     
-    def reproduce(self, popDensity):
+    def reproduce(self, popDensity, rand=None):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the SimplePatient and
@@ -60,25 +436,32 @@ class SimpleVirus(object):
 
         popDensity: the population density (a float), defined as the current
         virus population divided by the maximum population.         
+
+        rand: the source of uniform random numbers (a zero-argument callable).
+        Defaults to random.random.
         
         returns: a new instance of the SimpleVirus class representing the
         offspring of this virus particle. The child should have the same
         maxBirthProb and clearProb values as this virus. Raises a
         NoChildException if this virus particle does not reproduce.               
         """
-        if random.random() <= self.maxBirthProb * (1 - popDensity):
+        if rand is None:
+            rand = random.random
+        if rand() <= self.maxBirthProb * (1 - popDensity):
             #print 'virus has reproduced'
             return SimpleVirus( self.maxBirthProb, self.clearProb)
         else:
             raise NoChildException()
 
-class SimplePatient(object):
+class SimplePatient(Checkpointable, Instrumented):
     """
     Representation of a simplified patient. The patient does not take any drugs
     and his/her virus populations have no drug resistance.
     """
+
+    randomAttribute = 'stream'
     
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, swapRemove=False, rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes.
@@ -87,9 +470,37 @@ class SimplePatient(object):
         SimpleVirus instances)
         
         maxPop: the  maximum virus population for this patient (an integer)
+
+        swapRemove: if True, cleared viruses are removed in place by swapping
+        the last particle into their slot, which avoids building a new list
+        every time step but does not preserve the order of the population.
+
+        rng: where the per-particle random draws come from (a RandomStream, a
+        numpy.random.Generator or a seed). The module-level random generator is
+        used when omitted.
         """
         self.viruses = viruses
         self.maxPop = maxPop
+        self.swapRemove = swapRemove
+        self._setRandom(rng)
+
+    def _setRandom(self, rng):
+        self.stream = makeStream(rng)
+        self.rand = makeUniform(self.stream)
+
+    def _detach(self):
+        self.viruses = list(self.viruses)
+
+    def __getstate__(self):
+        # rand is rebuilt from the stream, which pickles on its own
+        state = Instrumented.__getstate__(self)
+        state.pop('rand', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'stream' in state:
+            self.rand = makeUniform(self.stream)
 
     def getTotalPop(self):
         """
@@ -99,6 +510,85 @@ class SimplePatient(object):
         """
         return len(self.viruses)     
 
+    def _clearViruses(self):
+        """
+        Determines whether each virus particle survives and updates the list of
+        virus particles accordingly, in a single linear pass. Every particle
+        gets exactly one doesClear() draw.
+
+        returns: the list of cleared virus particles
+
+        postcondition: self.viruses only holds the surviving particles
+        """
+        viruses = self.viruses
+        rand = self.rand
+        cleared = []
+        if not self.swapRemove:
+            survivors = []
+            for virus in viruses:
+                if virus.doesClear(rand):
+                    cleared.append(virus)
+                else:
+                    survivors.append(virus)
+            viruses[:] = survivors
+            return cleared
+        alive = len(viruses)
+        i = 0
+        while i < alive:
+            if viruses[i].doesClear(rand):
+                # the particle swapped in still needs its own draw
+                cleared.append(viruses[i])
+                alive -= 1
+                viruses[i] = viruses[alive]
+            else:
+                i += 1
+        del viruses[alive:]
+        return cleared
+
+    def _clearOver(self, steps):
+        """
+        Applies steps time steps worth of clearance at once: each particle
+        survives all of them with probability (1 - clearProb) ** steps.
+
+        returns: the list of cleared virus particles
+        """
+        rand = self.rand
+        survivors = []
+        cleared = []
+        for virus in self.viruses:
+            if rand() < (1 - virus.clearProb) ** steps:
+                survivors.append(virus)
+            else:
+                cleared.append(virus)
+        self.viruses[:] = survivors
+        return cleared
+
+    def isBlocked(self):
+        """
+        Tells whether no virus particle can reproduce any more. A blocked
+        population is absorbing: it can only shrink, since drugs are never
+        withdrawn. Without drugs that only happens once it is extinct.
+
+        returns: True if the population can no longer grow, otherwise False
+        """
+        return self.getTotalPop() == 0
+
+    def fastForward(self, steps):
+        """
+        Simulates steps time steps of a blocked population (see isBlocked())
+        in one pass. With no reproduction left, the population after steps
+        update() calls has exactly the distribution sampled here.
+
+        steps: the number of time steps to skip (an integer)
+
+        returns: the total virus population at the end (an integer)
+        """
+        if not self.isBlocked():
+            raise ValueError('fastForward() needs a population that can no '
+                             'longer reproduce')
+        self._clearOver(steps)
+        return self.getTotalPop()
+
     def update(self):
         """
         Update the state of the virus population in this patient for a single
@@ -116,20 +606,50 @@ class SimplePatient(object):
         returns: the total virus population at the end of the update (an
         integer)
         """
+        if self.profiler is not None:
+            return self._profiledUpdate()
         #print 'the old poplulation is', len(self.viruses)
         newViruses = []
-        for virus in self.viruses:
-            if virus.doesClear() == True:
-                self.viruses.remove(virus)
+        self._clearViruses()
         self.popDensity = float(self.getTotalPop()) / float(self.maxPop)
         for virus in self.viruses:
             try:
-                newViruses.append(virus.reproduce(self.popDensity))
+                newViruses.append(virus.reproduce(self.popDensity, self.rand))
             except NoChildException:
                     continue
         self.viruses.extend(newViruses)
         #print 'the new poplulation is', len(self.viruses)
         return len(self.viruses)
+
+    def _profiledUpdate(self):
+        """
+        update() with every phase timed and its events counted for
+        self.profiler. Draws the same random numbers as update(), so
+        profiling does not change the trajectory.
+        """
+        clock = self._clock
+        start = clock()
+        cleared = self._clearViruses()
+        clearedAt = clock()
+        self.popDensity = float(self.getTotalPop()) / float(self.maxPop)
+        densityAt = clock()
+        newViruses = []
+        for virus in self.viruses:
+            try:
+                newViruses.append(virus.reproduce(self.popDensity, self.rand))
+            except NoChildException:
+                continue
+        reproducedAt = clock()
+        self.viruses.extend(newViruses)
+        extendedAt = clock()
+        self.profiler.addStep(
+            self.profileId,
+            {'clearance': clearedAt - start,
+             'density': densityAt - clearedAt,
+             'reproduction': reproducedAt - densityAt,
+             'extension': extendedAt - reproducedAt},
+            {'clears': len(cleared), 'births': len(newViruses)})
+        return len(self.viruses)
             
 
 #
@@ -154,14 +674,9 @@ def problem2():
     for trial in range(0,300):
         populationList.append(patient.update())
 
-    plt.plot(list(range(0, 300)), populationList)
-    plt.title('Virus population VS Time')
-    plt.xlabel('Time steps')
-    plt.ylabel('virus population')
-    plt.grid()
-    plt.show()
-    
-#problem2()
+    import plots
+    plots.plotTimeSeries([(populationList, None)],
+                         title='Virus population VS Time')
     
 #
 # PROBLEM 3
@@ -171,6 +686,8 @@ class ResistantVirus(SimpleVirus):
     """
     Representation of a virus which can have drug resistance.
     """    
+
+    __slots__ = ('resistances', 'mutProb', 'resistMask')
     
     def __init__(self, maxBirthProb, clearProb, resistances, mutProb):
         """
@@ -188,11 +705,24 @@ class ResistantVirus(SimpleVirus):
 
         mutProb: Mutation probability for this virus particle (a float). This is
         the probability of the offspring acquiring or losing resistance to a drug.        
+
+        The resistances are also stored as a mask in DRUGS (resistMask), so
+        the dictionary should not be changed after the particle is created.
         """
         self.maxBirthProb = maxBirthProb
         self.clearProb = clearProb
         self.resistances = resistances
         self.mutProb = mutProb
+        mask = 0
+        for drug in resistances:
+            if resistances[drug]:
+                mask |= DRUGS.getBit(drug)
+        self.resistMask = mask
+
+    def __reduce__(self):
+        # the mask is rebuilt from the dictionary in the loading process
+        return (ResistantVirus, (self.maxBirthProb, self.clearProb,
+                                 self.resistances, self.mutProb))
         
     def getResistance(self, drug):
         """
@@ -209,8 +739,25 @@ class ResistantVirus(SimpleVirus):
             return self.resistances[drug]
         except KeyError:
             return False
+
+    def getResistantDrugs(self):
+        """
+        Get the set of drugs this virus particle is resistant to. Patient uses
+        it as the genotype key of the particle.
+
+        returns: a frozenset of drug names (strings)
+        """
+        resistances = self.resistances
+        return frozenset(drug for drug in resistances if resistances[drug])
+
+    def getResistanceMask(self):
+        """
+        returns: the mask in DRUGS of the drugs this virus particle is
+        resistant to (an integer)
+        """
+        return self.resistMask
         
-    def reproduce(self, popDensity, activeDrugs):
+    def reproduce(self, popDensity, activeDrugs, rand=None):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the Patient class.
@@ -242,7 +789,11 @@ class ResistantVirus(SimpleVirus):
         virus population divided by the maximum population        
 
         activeDrugs: a list of the drug names acting on this virus particle
-        (a list of strings). 
+        (a list of strings), or their mask in DRUGS (an integer), which
+        gates the particle with a single bitwise test.
+
+        rand: the source of uniform random numbers (a zero-argument callable).
+        Defaults to random.random.
         
         returns: a new instance of the ResistantVirus class representing the
         offspring of this virus particle. The child should have the same
@@ -250,17 +801,23 @@ class ResistantVirus(SimpleVirus):
         NoChildException if this virus particle does not reproduce.         
         """
         #first check if the virus is resistance to all drugs
-        for drug in activeDrugs:
-            if self.getResistance(drug) == False:
+        if isinstance(activeDrugs, int):
+            if activeDrugs & ~self.resistMask:
                 raise NoChildException()
+        else:
+            for drug in activeDrugs:
+                if self.getResistance(drug) == False:
+                    raise NoChildException()
+        if rand is None:
+            rand = random.random
         #reproduce with the probability
-        if random.random() <= (self.maxBirthProb * (1 - popDensity)):
+        if rand() <= (self.maxBirthProb * (1 - popDensity)):
             
             resistanceInheritance = {}
             for drug in self.resistances:
                 #check inheritance probabilties
                 #active drugs list
-                if random.random() <= self.mutProb:
+                if rand() <= self.mutProb:
                     resistanceInheritance[drug] = not self.getResistance(drug)
                 else:
                     resistanceInheritance[drug] = self.getResistance(drug)
@@ -274,13 +831,21 @@ class ResistantVirus(SimpleVirus):
         
         
             
-class Patient(SimplePatient):
+class Patient(Treatable, SimplePatient):
     """
     Representation of a patient. The patient is able to take drugs and his/her
     virus population can acquire resistance to the drugs he/she takes.
+
+    The patient keeps a count of its viruses per resistance genotype (the
+    mask in DRUGS of the drugs a particle resists), updated as viruses are
+    cleared and born, so getResistPop() does not rescan the population. Call
+    recountResistances() after changing self.viruses by hand. The
+    prescriptions are cached as a mask too (prescriptionMask), which update()
+    hands to reproduce().
     """
     
-    def __init__(self, viruses, maxPop):
+    def __init__(self, viruses, maxPop, swapRemove=False, checkCounts=False,
+                 rng=None):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes. Also initializes the list of drugs being administered
@@ -290,32 +855,53 @@ class Patient(SimplePatient):
         SimpleVirus instances)
         
         maxPop: the  maximum virus population for this patient (an integer)
+
+        swapRemove: if True, cleared viruses are removed in place without
+        preserving the order of the population (see SimplePatient).
+
+        checkCounts: if True, every getResistPop() call is cross-checked
+        against a full scan of the population (for debugging).
+
+        rng: where the per-particle random draws come from (see
+        SimplePatient).
         """
         self.viruses = viruses
         self.maxPop = maxPop
+        self.swapRemove = swapRemove
+        self._setRandom(rng)
+        self.checkCounts = checkCounts
         self.drugs = []
-        
-    def addPrescription(self, newDrug):
-        """
-        Administer a drug to this patient. After a prescription is added, the 
-        drug acts on the virus population for all subsequent time steps. If the
-        newDrug is already prescribed to this patient, the method has no effect.
+        self.prescriptionMask = 0
+        self.recountResistances()
 
-        newDrug: The name of the drug to administer to the patient (a string).
+    def _detach(self):
+        SimplePatient._detach(self)
+        self.drugs = list(self.drugs)
+        self.genotypeCounts = self.genotypeCounts.copy()
+        self.resistCache = dict(self.resistCache)
 
-        postcondition: list of drugs being administered to a patient is updated
-        """
-        if newDrug not in self.drugs:
-            self.drugs.append(newDrug)
+    def __setstate__(self, state):
+        # masks are only valid in the process that built them
+        SimplePatient.__setstate__(self, state)
+        self.prescriptionMask = DRUGS.getMask(self.drugs)
+        if 'genotypeCounts' in state:
+            self.recountResistances()
 
-    def getPrescriptions(self):
+    def fastForward(self, steps):
         """
-        Returns the drugs that are being administered to this patient.
+        Simulates steps time steps of a blocked population in one pass (see
+        SimplePatient.fastForward()).
 
-        returns: The list of drug names (strings) being administered to this
-        patient.
+        returns: the total virus population at the end (an integer)
         """
-        return self.drugs
+        if not self.isBlocked():
+            raise ValueError('fastForward() needs a population that can no '
+                             'longer reproduce')
+        genotypeCounts = self.genotypeCounts
+        for virus in self._clearOver(steps):
+            genotypeCounts[self._genotype(virus)] -= 1
+        self.resistCache = {}
+        return self.getTotalPop()
         
     def getResistPop(self, drugResist):
         """
@@ -325,6 +911,31 @@ class Patient(SimplePatient):
         drugResist: Which drug resistances to include in the population (a list
         of strings - e.g. ['guttagonol'] or ['guttagonol', 'grimpex'])
 
+        returns: the population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        mask = DRUGS.getMask(drugResist)
+        try:
+            totalResistant = self.resistCache[mask]
+        except KeyError:
+            totalResistant = 0
+            for genotype, count in self.genotypeCounts.items():
+                if genotype & mask == mask:
+                    totalResistant += count
+            self.resistCache[mask] = totalResistant
+        if self.checkCounts:
+            scanned = self.scanResistPop(drugResist)
+            if scanned != totalResistant:
+                raise RuntimeError('resistant count for %s is %d but a full '
+                                   'scan finds %d' % (sorted(set(drugResist)),
+                                                      totalResistant, scanned))
+        return totalResistant
+
+    def scanResistPop(self, drugResist):
+        """
+        Same as getResistPop(), but counts by scanning every virus particle
+        instead of using the genotype counts.
+
         returns: the population of viruses (an integer) with resistances to all
         drugs in the drugResist list.
         """
@@ -339,6 +950,27 @@ class Patient(SimplePatient):
                 #print 'found resistant', totalResistant
                 totalResistant = totalResistant + 1
         return totalResistant
+
+    def _genotype(self, virus):
+        """
+        returns: the mask in DRUGS of the drugs the virus particle resists (an
+        integer)
+        """
+        try:
+            return virus.getResistanceMask()
+        except AttributeError:
+            # a SimpleVirus resists nothing
+            return 0
+
+    def recountResistances(self):
+        """
+        Rebuilds the per-genotype counts from a full scan of the population.
+
+        postcondition: self.genotypeCounts matches self.viruses
+        """
+        self.genotypeCounts = collections.Counter(
+            self._genotype(virus) for virus in self.viruses)
+        self.resistCache = {}
                 
 
     def update(self):
@@ -360,27 +992,1146 @@ class Patient(SimplePatient):
         returns: the total virus population at the end of the update (an
         integer)
         """
+        if self.profiler is not None:
+            return self._profiledUpdate()
         newViruses = []
-        for virus in self.viruses:
-            if virus.doesClear() == True:
-                self.viruses.remove(virus)
+        genotypeCounts = self.genotypeCounts
+        for virus in self._clearViruses():
+            genotypeCounts[self._genotype(virus)] -= 1
         self.popDensity = self.getTotalPop() / float(self.maxPop)
+        prescriptionMask = self.prescriptionMask
         for virus in self.viruses:
             try:
-                child = virus.reproduce(self.popDensity, self.getPrescriptions())
+                child = virus.reproduce(self.popDensity, prescriptionMask,
+                                        self.rand)
                 newViruses.append(child)
+                genotypeCounts[self._genotype(child)] += 1
             except NoChildException:
                     continue
         self.viruses.extend(newViruses)
+        self.resistCache = {}
         #print 'the new poplulation is', len(self.viruses)
         return self.getTotalPop()
-        
+
+    def _profiledUpdate(self):
+        """
+        update() with every phase timed and its events counted for
+        self.profiler. Gating on the prescriptions runs as its own pass here,
+        before reproduce() is called on the eligible particles. Particles
+        that fail the gate draw no random numbers, so the trajectory is the
+        same as without profiling. Mutation draws happen inside reproduce()
+        and are timed as reproduction; the mutation phase covers resolving
+        the offspring's genotypes, and a mutation event is one flipped trait.
+        """
+        clock = self._clock
+        genotypeCounts = self.genotypeCounts
+        start = clock()
+        cleared = self._clearViruses()
+        for virus in cleared:
+            genotypeCounts[self._genotype(virus)] -= 1
+        clearedAt = clock()
+        self.popDensity = self.getTotalPop() / float(self.maxPop)
+        densityAt = clock()
+        prescriptionMask = self.prescriptionMask
+        parents = [virus for virus in self.viruses
+                   if not prescriptionMask & ~self._genotype(virus)]
+        gatedAt = clock()
+        births = []
+        for virus in parents:
+            try:
+                births.append((virus, virus.reproduce(self.popDensity,
+                                                      prescriptionMask,
+                                                      self.rand)))
+            except NoChildException:
+                continue
+        reproducedAt = clock()
+        newViruses = []
+        mutations = 0
+        for parent, child in births:
+            genotype = self._genotype(child)
+            mutations += bin(genotype ^ self._genotype(parent)).count('1')
+            genotypeCounts[genotype] += 1
+            newViruses.append(child)
+        mutatedAt = clock()
+        self.viruses.extend(newViruses)
+        self.resistCache = {}
+        extendedAt = clock()
+        self.profiler.addStep(
+            self.profileId,
+            {'clearance': clearedAt - start,
+             'density': densityAt - clearedAt,
+             'gating': gatedAt - densityAt,
+             'reproduction': reproducedAt - gatedAt,
+             'mutation': mutatedAt - reproducedAt,
+             'extension': extendedAt - mutatedAt},
+            {'clears': len(cleared), 'births': len(newViruses),
+             'mutations': mutations})
+        return self.getTotalPop()
+
 
 #
-# PROBLEM 4
+# COMPACT VIRUSES
 #
 
-def problem4():
+class Strain(object):
+    """
+    Parameters shared by every particle of a virus strain: maxBirthProb,
+    clearProb, mutProb and the drugs the strain can become resistant to. Each
+    drug has its bit in DRUGS, so a particle's resistances are a single
+    integer (its genotype), comparable with any other mask in DRUGS.
+    """
+
+    __slots__ = ('maxBirthProb', 'clearProb', 'mutProb', 'drugNames',
+                 'drugBits', 'bits', 'resistantDrugs')
+
+    def __init__(self, maxBirthProb, clearProb, drugNames, mutProb):
+        """
+        maxBirthProb: Maximum reproduction probability (a float between 0-1)
+
+        clearProb: Maximum clearance probability (a float between 0-1).
+
+        drugNames: the drugs the strain tracks resistance to (a sequence of
+        strings)
+
+        mutProb: Mutation probability of each resistance trait (a float).
+        """
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
+        self.mutProb = mutProb
+        self.drugNames = tuple(drugNames)
+        self.bits = tuple(DRUGS.getBit(drug) for drug in self.drugNames)
+        self.drugBits = dict(zip(self.drugNames, self.bits))
+        self.resistantDrugs = {}
+
+    def __reduce__(self):
+        # the bits are reassigned by the registry of the loading process
+        return (Strain, (self.maxBirthProb, self.clearProb, self.drugNames,
+                         self.mutProb))
+
+    def getGenotype(self, resistances):
+        """
+        resistances: A dictionary of drug names (strings) mapping to the state
+        of resistance (either True or False), as taken by ResistantVirus.
+
+        returns: the genotype bit mask (an integer)
+        """
+        genotype = 0
+        for drug in resistances:
+            if resistances[drug]:
+                genotype |= self.drugBits[drug]
+        return genotype
+
+    def getResistantDrugs(self, genotype):
+        """
+        returns: the drugs resisted by a genotype (a frozenset of strings). The
+        set is built once per genotype and shared by every particle.
+        """
+        try:
+            return self.resistantDrugs[genotype]
+        except KeyError:
+            drugs = frozenset(drug for drug in self.drugNames
+                              if genotype & self.drugBits[drug])
+            self.resistantDrugs[genotype] = drugs
+            return drugs
+
+    def makeViruses(self, number, resistances=None):
+        """
+        returns: a list of number CompactVirus particles of this strain with
+        the given resistances (a dictionary as taken by ResistantVirus; no
+        resistances when omitted)
+        """
+        genotype = self.getGenotype(resistances or {})
+        return [CompactVirus(self, genotype) for x in range(number)]
+
+
+class CompactVirus(object):
+    """
+    Memory-lean stand-in for ResistantVirus. A particle only stores a reference
+    to its Strain and its genotype bit mask; the strain parameters and the
+    resistances dictionary are derived on demand. It can be mixed into any
+    Patient in place of ResistantVirus.
+    """
+
+    __slots__ = ('strain', 'genotype')
+
+    def __init__(self, strain, genotype=0):
+        """
+        strain: the shared parameters of this particle (a Strain)
+
+        genotype: the resistance bit mask of this particle (an integer)
+        """
+        self.strain = strain
+        self.genotype = genotype
+
+    def __reduce__(self):
+        # genotypes are stored by drug name, see Strain.__reduce__()
+        return (_loadCompactVirus, (self.strain,
+                                    sorted(self.getResistantDrugs())))
+
+    @property
+    def maxBirthProb(self):
+        return self.strain.maxBirthProb
+
+    @property
+    def clearProb(self):
+        return self.strain.clearProb
+
+    @property
+    def mutProb(self):
+        return self.strain.mutProb
+
+    @property
+    def resistances(self):
+        """
+        returns: a new dictionary of drug names mapping to the state of this
+        particle's resistance, in the ResistantVirus format.
+        """
+        resistances = {}
+        for drug in self.strain.drugNames:
+            resistances[drug] = bool(self.genotype & self.strain.drugBits[drug])
+        return resistances
+
+    def getResistance(self, drug):
+        """
+        returns: True if this virus particle is resistant to the drug (a
+        string), False otherwise.
+        """
+        bit = self.strain.drugBits.get(drug, 0)
+        return bool(self.genotype & bit)
+
+    def getResistantDrugs(self):
+        """
+        returns: the drugs this virus particle resists (an interned frozenset
+        of strings)
+        """
+        return self.strain.getResistantDrugs(self.genotype)
+
+    def getResistanceMask(self):
+        """
+        returns: the mask in DRUGS of the drugs this virus particle is
+        resistant to, i.e. its genotype (an integer)
+        """
+        return self.genotype
+
+    def doesClear(self, rand=None):
+        """
+        rand: the source of uniform random numbers (a zero-argument callable).
+        Defaults to random.random.
+
+        returns: True with probability clearProb of the strain, otherwise
+        False.
+        """
+        if rand is None:
+            rand = random.random
+        return rand() <= self.strain.clearProb
+
+    def reproduce(self, popDensity, activeDrugs, rand=None):
+        """
+        Same contract as ResistantVirus.reproduce(): the particle only
+        reproduces if it resists every drug in activeDrugs, then with
+        probability maxBirthProb * (1 - popDensity). Each resistance trait of
+        the offspring flips with probability mutProb.
+
+        returns: a new CompactVirus of the same strain. Raises a
+        NoChildException if this virus particle does not reproduce.
+        """
+        strain = self.strain
+        genotype = self.genotype
+        if isinstance(activeDrugs, int):
+            if activeDrugs & ~genotype:
+                raise NoChildException()
+        else:
+            for drug in activeDrugs:
+                if not genotype & strain.drugBits.get(drug, 0):
+                    raise NoChildException()
+        if rand is None:
+            rand = random.random
+        if rand() <= strain.maxBirthProb * (1 - popDensity):
+            mutProb = strain.mutProb
+            for bit in strain.bits:
+                if rand() <= mutProb:
+                    genotype ^= bit
+            return CompactVirus(strain, genotype)
+        else:
+            raise NoChildException()
+
+
+
+def _loadCompactVirus(strain, resistantDrugs):
+    """
+    Rebuilds a pickled CompactVirus.
+
+    returns: a CompactVirus of strain resistant to resistantDrugs (a list of
+    strings)
+    """
+    genotype = 0
+    for drug in resistantDrugs:
+        genotype |= strain.drugBits[drug]
+    return CompactVirus(strain, genotype)
+
+
+#
+# ARRAY-BACKED PATIENT
+#
+
+class ArrayPatient(Treatable, Checkpointable, Instrumented):
+    """
+    Representation of a patient whose virus population is stored as NumPy
+    arrays instead of a list of virus objects. It samples the same process as
+    Patient (and SimplePatient when no drugs are prescribed), but every phase of
+    update() is a handful of batched array operations over the whole population.
+
+    It offers Patient's interface, not its implementation: there is no list of
+    particles to clear, swap or recount, so none of the list-based helpers of
+    SimplePatient and Patient exist here.
+    """
+
+    randomAttribute = 'rng'
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, converts the viruses into per-particle arrays
+        and saves the maxPop parameter as an attribute. Also initializes the
+        list of drugs being administered (which should initially include no
+        drugs).
+
+        viruses: the list representing the initial virus population (a list of
+        SimpleVirus or ResistantVirus instances). All resistant viruses are
+        expected to track the same drugs, as they do in the problem drivers.
+
+        maxPop: the  maximum virus population for this patient (an integer)
+
+        rng: the random generator used for every draw (anything accepted by
+        makeGenerator). A freshly seeded generator is created when omitted.
+        """
+        self.maxPop = maxPop
+        self.drugs = []
+        self.prescriptionMask = 0
+        self.rng = makeGenerator(rng)
+        drugNames = []
+        for virus in viruses:
+            for drug in getattr(virus, 'resistances', {}):
+                if drug not in drugNames:
+                    drugNames.append(drug)
+        self.drugNames = drugNames
+        self.birthProbs = numpy.array([v.maxBirthProb for v in viruses],
+                                      dtype=float)
+        self.clearProbs = numpy.array([v.clearProb for v in viruses],
+                                      dtype=float)
+        self.mutProbs = numpy.array([getattr(v, 'mutProb', 0.0)
+                                     for v in viruses], dtype=float)
+        self.resistances = numpy.zeros((len(viruses), len(drugNames)),
+                                       dtype=bool)
+        for i, virus in enumerate(viruses):
+            if hasattr(virus, 'getResistance'):
+                for j, drug in enumerate(drugNames):
+                    self.resistances[i, j] = bool(virus.getResistance(drug))
+
+    def _setRandom(self, rng):
+        self.rng = makeGenerator(rng)
+
+    def _detach(self):
+        # the arrays are replaced, never modified, by update()
+        self.drugs = list(self.drugs)
+
+    @property
+    def viruses(self):
+        """
+        Builds the object view of the population, for code that inspects
+        individual particles. The arrays remain the source of truth: the list
+        is rebuilt on every access, so changing it does not change the patient.
+
+        returns: a list of ResistantVirus instances
+        """
+        viruses = []
+        for i in range(self.getTotalPop()):
+            resistances = {}
+            for j, drug in enumerate(self.drugNames):
+                resistances[drug] = bool(self.resistances[i, j])
+            viruses.append(ResistantVirus(float(self.birthProbs[i]),
+                                          float(self.clearProbs[i]),
+                                          resistances,
+                                          float(self.mutProbs[i])))
+        return viruses
+
+    def getTotalPop(self):
+        """
+        Gets the current total virus population.
+
+        returns: The total virus population (an integer)
+        """
+        return len(self.birthProbs)
+
+    def _drugColumns(self, drugs):
+        """
+        Maps drug names to resistance columns.
+
+        returns: the list of column indices, or None if one of the drugs is not
+        tracked by any particle (so no particle can be resistant to it).
+        """
+        columns = []
+        for drug in drugs:
+            if drug not in self.drugNames:
+                return None
+            columns.append(self.drugNames.index(drug))
+        return columns
+
+    def _resistantMask(self, drugs):
+        """
+        returns: a boolean array flagging the particles resistant to every drug
+        in drugs.
+        """
+        columns = self._drugColumns(drugs)
+        if columns is None:
+            return numpy.zeros(self.getTotalPop(), dtype=bool)
+        return self.resistances[:, columns].all(axis=1)
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'grimpex'])
+
+        returns: the population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        return int(numpy.count_nonzero(self._resistantMask(drugResist)))
+
+    def _keep(self, survivors):
+        """
+        Drops the particles not flagged in survivors (a boolean array).
+        """
+        self.birthProbs = self.birthProbs[survivors]
+        self.clearProbs = self.clearProbs[survivors]
+        self.mutProbs = self.mutProbs[survivors]
+        self.resistances = self.resistances[survivors]
+
+    def fastForward(self, steps):
+        """
+        Simulates steps time steps of a blocked population in one pass (see
+        SimplePatient.fastForward()).
+
+        returns: the total virus population at the end (an integer)
+        """
+        if not self.isBlocked():
+            raise ValueError('fastForward() needs a population that can no '
+                             'longer reproduce')
+        survival = (1 - self.clearProbs) ** steps
+        self._keep(self.rng.random(self.getTotalPop()) < survival)
+        return self.getTotalPop()
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as Patient.update(): clearance, population
+        density, then reproduction (gated on the prescribed drugs) with
+        per-trait mutation of the offspring.
+
+        returns: the total virus population at the end of the update (an
+        integer)
+        """
+        rng = self.rng
+        clock = self._clock
+        start = clock()
+        before = self.getTotalPop()
+        self._keep(rng.random(self.getTotalPop()) > self.clearProbs)
+        clearedAt = clock()
+
+        self.popDensity = self.getTotalPop() / float(self.maxPop)
+        densityAt = clock()
+
+        eligible = self._resistantMask(self.getPrescriptions())
+        gatedAt = clock()
+        births = rng.random(self.getTotalPop()) <= \
+                 self.birthProbs * (1 - self.popDensity)
+        parents = numpy.flatnonzero(eligible & births)
+        reproducedAt = mutatedAt = clock()
+        flips = None
+        if len(parents):
+            mutProbs = self.mutProbs[parents]
+            flips = rng.random((len(parents), len(self.drugNames))) <= \
+                    mutProbs[:, numpy.newaxis]
+            mutatedAt = clock()
+            self.birthProbs = numpy.concatenate((self.birthProbs,
+                                                 self.birthProbs[parents]))
+            self.clearProbs = numpy.concatenate((self.clearProbs,
+                                                 self.clearProbs[parents]))
+            self.mutProbs = numpy.concatenate((self.mutProbs, mutProbs))
+            self.resistances = numpy.concatenate(
+                (self.resistances, self.resistances[parents] ^ flips))
+        if self.profiler is not None:
+            self.profiler.addStep(
+                self.profileId,
+                {'clearance': clearedAt - start,
+                 'density': densityAt - clearedAt,
+                 'gating': gatedAt - densityAt,
+                 'reproduction': reproducedAt - gatedAt,
+                 'mutation': mutatedAt - reproducedAt,
+                 'extension': clock() - mutatedAt},
+                {'clears': before - (self.getTotalPop() - len(parents)),
+                 'births': len(parents),
+                 'mutations': 0 if flips is None
+                              else int(numpy.count_nonzero(flips))})
+        return self.getTotalPop()
+
+
+#
+# GENOTYPE-COUNT PATIENT
+#
+
+class GenotypePatient(Treatable, Checkpointable, Instrumented):
+    """
+    Representation of a patient whose virus population is stored as one
+    integer count per resistance genotype. With k tracked drugs there are at
+    most 2**k genotypes, so a time step costs O(k * 2**k) regardless of how
+    many particles are alive.
+
+    Genotype g is resistant to drugNames[j] when bit j of g is set. All
+    particles share maxBirthProb, clearProb and mutProb, which holds for every
+    population the problem drivers build. Like ArrayPatient, it has Patient's
+    interface but keeps no list of particles.
+    """
+
+    randomAttribute = 'rng'
+
+    def __init__(self, viruses, maxPop, rng=None):
+        """
+        Initialization function, tallies the viruses by genotype and saves the
+        maxPop parameter as an attribute. Also initializes the list of drugs
+        being administered (which should initially include no drugs).
+
+        viruses: the list representing the initial virus population (a
+        non-empty list of SimpleVirus or ResistantVirus instances sharing the
+        same maxBirthProb, clearProb and mutProb)
+
+        maxPop: the  maximum virus population for this patient (an integer)
+
+        rng: the random generator used for every draw (anything accepted by
+        makeGenerator). A freshly seeded generator is created when omitted.
+        """
+        if len(viruses) == 0:
+            raise ValueError('GenotypePatient needs at least one virus to '
+                             'take the strain parameters from')
+        self.maxPop = maxPop
+        self.drugs = []
+        self.prescriptionMask = 0
+        self.rng = makeGenerator(rng)
+        first = viruses[0]
+        self.maxBirthProb = float(first.maxBirthProb)
+        self.clearProb = float(first.clearProb)
+        self.mutProb = float(getattr(first, 'mutProb', 0.0))
+        drugNames = []
+        for virus in viruses:
+            if (float(virus.maxBirthProb) != self.maxBirthProb or
+                    float(virus.clearProb) != self.clearProb or
+                    float(getattr(virus, 'mutProb', 0.0)) != self.mutProb):
+                raise ValueError('GenotypePatient requires all viruses to '
+                                 'share maxBirthProb, clearProb and mutProb')
+            for drug in getattr(virus, 'resistances', {}):
+                if drug not in drugNames:
+                    drugNames.append(drug)
+        self.drugNames = drugNames
+        self.counts = numpy.zeros(2 ** len(drugNames), dtype=numpy.int64)
+        for virus in viruses:
+            genotype = 0
+            if hasattr(virus, 'getResistance'):
+                for j, drug in enumerate(drugNames):
+                    if virus.getResistance(drug):
+                        genotype |= 1 << j
+            self.counts[genotype] += 1
+        self.genotypes = numpy.arange(len(self.counts))
+        self.eligible = numpy.ones(len(self.counts), dtype=bool)
+
+    def _setRandom(self, rng):
+        self.rng = makeGenerator(rng)
+
+    def _detach(self):
+        # the counts are replaced, never modified, by update()
+        self.drugs = list(self.drugs)
+
+    def getTotalPop(self):
+        """
+        Gets the current total virus population.
+
+        returns: The total virus population (an integer)
+        """
+        return int(self.counts.sum())
+
+    def _drugMask(self, drugs):
+        """
+        Maps drug names to a genotype bit mask.
+
+        returns: the mask (an integer), or None if one of the drugs is not
+        tracked (so no genotype can be resistant to it).
+        """
+        mask = 0
+        for drug in drugs:
+            if drug not in self.drugNames:
+                return None
+            mask |= 1 << self.drugNames.index(drug)
+        return mask
+
+    def _resistantGenotypes(self, drugs):
+        """
+        returns: a boolean array flagging the genotypes resistant to every drug
+        in drugs.
+        """
+        mask = self._drugMask(drugs)
+        if mask is None:
+            return numpy.zeros(len(self.counts), dtype=bool)
+        return (self.genotypes & mask) == mask
+
+    def addPrescription(self, newDrug):
+        """
+        Administer a drug to this patient (see Treatable.addPrescription()),
+        and recompute which genotypes may still reproduce (self.eligible), so
+        update() does not redo it every time step.
+        """
+        Treatable.addPrescription(self, newDrug)
+        self.eligible = self._resistantGenotypes(self.getPrescriptions())
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'grimpex'])
+
+        returns: the population of viruses (an integer) with resistances to all
+        drugs in the drugResist list.
+        """
+        return int(self.counts[self._resistantGenotypes(drugResist)].sum())
+
+    def fastForward(self, steps):
+        """
+        Simulates steps time steps of a blocked population in one pass (see
+        SimplePatient.fastForward()).
+
+        returns: the total virus population at the end (an integer)
+        """
+        if not self.isBlocked():
+            raise ValueError('fastForward() needs a population that can no '
+                             'longer reproduce')
+        self.counts = self.rng.binomial(self.counts,
+                                        (1 - self.clearProb) ** steps)
+        return self.getTotalPop()
+
+    def _mutate(self, children, tally=None):
+        """
+        Applies per-trait mutation to offspring counts. Each trait flips
+        independently with probability mutProb, so the bits are resolved one
+        at a time with a binomial draw per genotype.
+
+        children: offspring counts indexed by their parents' genotype (an
+        array of integers)
+
+        tally: if given, the number of flipped traits is appended to it (a
+        list)
+
+        returns: offspring counts indexed by their own genotype
+        """
+        for j in range(len(self.drugNames)):
+            flipped = self.rng.binomial(children, self.mutProb)
+            children = children - flipped
+            children[self.genotypes ^ (1 << j)] += flipped
+            if tally is not None:
+                tally.append(int(flipped.sum()))
+        return children
+
+    def update(self):
+        """
+        Update the state of the virus population in this patient for a single
+        time step, in the same order as Patient.update(): clearance, population
+        density, then reproduction (gated on the prescribed drugs) with
+        per-trait mutation of the offspring.
+
+        returns: the total virus population at the end of the update (an
+        integer)
+        """
+        rng = self.rng
+        clock = self._clock
+        start = clock()
+        before = self.getTotalPop() if self.profiler is not None else None
+        self.counts = rng.binomial(self.counts, 1 - self.clearProb)
+        clearedAt = clock()
+        self.popDensity = self.getTotalPop() / float(self.maxPop)
+        birthProb = min(max(self.maxBirthProb * (1 - self.popDensity), 0.0),
+                        1.0)
+        densityAt = clock()
+        eligible = self.eligible
+        gatedAt = clock()
+        children = numpy.where(eligible,
+                               rng.binomial(self.counts, birthProb), 0)
+        reproducedAt = clock()
+        if self.profiler is None:
+            self.counts = self.counts + self._mutate(children)
+            return self.getTotalPop()
+        flips = []
+        offspring = self._mutate(children, flips)
+        mutatedAt = clock()
+        survivors = self.getTotalPop()
+        self.counts = self.counts + offspring
+        self.profiler.addStep(
+            self.profileId,
+            {'clearance': clearedAt - start,
+             'density': densityAt - clearedAt,
+             'gating': gatedAt - densityAt,
+             'reproduction': reproducedAt - gatedAt,
+             'mutation': mutatedAt - reproducedAt,
+             'extension': clock() - mutatedAt},
+            {'clears': before - survivors, 'births': int(children.sum()),
+             'mutations': sum(flips)})
+        return self.getTotalPop()
+
+
+#
+# BATCHED PATIENTS
+#
+
+class PatientBatch(Checkpointable, Instrumented):
+    """
+    Representation of a cohort of independent patients that are advanced
+    together. The populations are stacked into one (patients x genotypes)
+    array of counts, with the same genotype encoding as GenotypePatient, and
+    every patient has its own prescription mask. A time step for the whole
+    cohort is a handful of array operations.
+
+    The per-patient methods mirror Patient but return one value per patient
+    (numpy arrays), so drivers written against Patient work unchanged.
+    """
+
+    def __init__(self, viruses, maxPop, numberOfPatients, rng=None):
+        """
+        Initialization function, infects every patient with the same initial
+        viruses. No drugs are administered initially.
+
+        viruses: the initial virus population of each patient (a non-empty list
+        of SimpleVirus or ResistantVirus instances sharing the same
+        maxBirthProb, clearProb and mutProb)
+
+        maxPop: the maximum virus population (an integer, or an array of one
+        integer per patient)
+
+        numberOfPatients: the number of patients in the batch (an integer)
+
+        rng: the random generator used for every draw (anything accepted by
+        makeGenerator). A freshly seeded generator is created when omitted.
+        """
+        rng = makeGenerator(rng)
+        template = GenotypePatient(viruses, 1, rng=rng)
+        self.rng = rng
+        self.maxBirthProb = template.maxBirthProb
+        self.clearProb = template.clearProb
+        self.mutProb = template.mutProb
+        self.drugNames = template.drugNames
+        self.genotypes = template.genotypes
+        self.maxPop = numpy.broadcast_to(
+            numpy.asarray(maxPop, dtype=float), (numberOfPatients,)).copy()
+        self.counts = numpy.tile(template.counts, (numberOfPatients, 1))
+        self.drugMasks = numpy.zeros(numberOfPatients, dtype=numpy.int64)
+        # patients given a drug no genotype tracks can never reproduce
+        self.blocked = numpy.zeros(numberOfPatients, dtype=bool)
+        self.drugs = [[] for x in range(numberOfPatients)]
+
+    def _detach(self):
+        # the counts are replaced, never modified, by update()
+        self.drugMasks = self.drugMasks.copy()
+        self.blocked = self.blocked.copy()
+        self.drugs = [list(drugs) for drugs in self.drugs]
+
+    def getNumberOfPatients(self):
+        """
+        returns: the number of patients in the batch (an integer)
+        """
+        return len(self.counts)
+
+    def getTotalPop(self):
+        """
+        Gets the current total virus population of every patient.
+
+        returns: an array of integers, one per patient
+        """
+        return self.counts.sum(axis=1)
+
+    def addPrescription(self, newDrug, patients=None):
+        """
+        Administer a drug to some or all patients of the batch. Patients that
+        already take newDrug are unaffected.
+
+        newDrug: The name of the drug to administer (a string).
+
+        patients: which patients receive the drug (anything that indexes a
+        numpy array: an index, a list of indices or a boolean mask). All
+        patients when omitted.
+        """
+        if patients is None:
+            patients = slice(None)
+        selected = numpy.zeros(self.getNumberOfPatients(), dtype=bool)
+        selected[patients] = True
+        for i in numpy.flatnonzero(selected):
+            if newDrug not in self.drugs[i]:
+                self.drugs[i].append(newDrug)
+        if newDrug in self.drugNames:
+            self.drugMasks[selected] |= 1 << self.drugNames.index(newDrug)
+        else:
+            self.blocked[selected] = True
+
+    def getPrescriptions(self, patient):
+        """
+        returns: The list of drug names (strings) being administered to the
+        given patient (an index).
+        """
+        return self.drugs[patient]
+
+    def getResistPop(self, drugResist):
+        """
+        Get the population of virus particles resistant to the drugs listed in
+        drugResist, for every patient.
+
+        drugResist: Which drug resistances to include in the population (a list
+        of strings - e.g. ['guttagonol'] or ['guttagonol', 'grimpex'])
+
+        returns: an array of integers, one per patient
+        """
+        mask = 0
+        for drug in drugResist:
+            if drug not in self.drugNames:
+                return numpy.zeros(self.getNumberOfPatients(),
+                                   dtype=numpy.int64)
+            mask |= 1 << self.drugNames.index(drug)
+        resistant = (self.genotypes & mask) == mask
+        return self.counts[:, resistant].sum(axis=1)
+
+    def _eligible(self):
+        """
+        returns: which genotypes may reproduce in which patient under their
+        prescriptions (a patients x genotypes boolean array)
+        """
+        masks = self.drugMasks[:, numpy.newaxis]
+        return ((self.genotypes[numpy.newaxis, :] & masks) == masks) & \
+               ~self.blocked[:, numpy.newaxis]
+
+    def isBlocked(self):
+        """
+        Tells, for every patient, whether no virus particle can reproduce any
+        more (see SimplePatient.isBlocked()).
+
+        returns: an array of booleans, one per patient
+        """
+        return ~(self.counts * self._eligible()).any(axis=1)
+
+    def fastForward(self, steps):
+        """
+        Simulates steps time steps for a batch whose patients are all blocked,
+        in one pass (see SimplePatient.fastForward()).
+
+        returns: the total virus population of every patient at the end (an
+        array of integers)
+        """
+        if not self.isBlocked().all():
+            raise ValueError('fastForward() needs populations that can no '
+                             'longer reproduce')
+        self.counts = self.rng.binomial(self.counts,
+                                        (1 - self.clearProb) ** steps)
+        return self.getTotalPop()
+
+    def update(self):
+        """
+        Update the state of the virus population of every patient for a single
+        time step, in the same order as Patient.update(): clearance, population
+        density, then reproduction (gated on each patient's prescriptions) with
+        per-trait mutation of the offspring.
+
+        returns: the total virus population of every patient at the end of
+        the update (an array of integers)
+        """
+        rng = self.rng
+        clock = self._clock
+        profiling = self.profiler is not None
+        start = clock()
+        before = self.getTotalPop() if profiling else None
+        self.counts = rng.binomial(self.counts, 1 - self.clearProb)
+        clearedAt = clock()
+        self.popDensity = self.getTotalPop() / self.maxPop
+        birthProbs = numpy.clip(self.maxBirthProb * (1 - self.popDensity),
+                                0.0, 1.0)
+        densityAt = clock()
+        eligible = self._eligible()
+        gatedAt = clock()
+        children = numpy.where(
+            eligible, rng.binomial(self.counts, birthProbs[:, numpy.newaxis]),
+            0)
+        reproducedAt = clock()
+        births = children.sum(axis=1) if profiling else None
+        mutations = 0
+        for j in range(len(self.drugNames)):
+            flipped = rng.binomial(children, self.mutProb)
+            children = children - flipped
+            children[:, self.genotypes ^ (1 << j)] += flipped
+            if profiling:
+                mutations = mutations + flipped.sum(axis=1)
+        mutatedAt = clock()
+        survivors = self.getTotalPop() if profiling else None
+        self.counts = self.counts + children
+        if profiling:
+            self.profiler.addStep(
+                self.profileId,
+                {'clearance': clearedAt - start,
+                 'density': densityAt - clearedAt,
+                 'gating': gatedAt - densityAt,
+                 'reproduction': reproducedAt - gatedAt,
+                 'mutation': mutatedAt - reproducedAt,
+                 'extension': clock() - mutatedAt},
+                {'clears': before - survivors, 'births': births,
+                 'mutations': mutations})
+        return self.getTotalPop()
+
+
+#
+# HYBRID PATIENT
+#
+
+class HybridPatient(GenotypePatient):
+    """
+    GenotypePatient with an approximate integrator for large populations.
+
+    update() is still one exact time step. advance() covers several time steps
+    at once with tau-leaping. The birth probability of every step of a leap
+    is taken from the expected population, followed one step at a time, and
+    the leap is kept short enough that the population cannot drift by more
+    than tolerance. Over a leap, abundant genotypes (at least criticalCount
+    particles) jump to the mean and variance of the branching process with
+    one Gaussian draw; the variance accounts for the damping of fluctuations
+    by density regulation. Rare genotypes, where resistance emerges, are
+    still sampled exactly every step, and receive the mutants born from the
+    abundant genotypes at the steps they are expected to be born at. The
+    mutants of rare parents are moved at the end of the leap.
+
+    At maxPop 10**6 the final populations of problem4-style arms agree with
+    GenotypePatient in mean and spread to within sampling error over 400
+    patients, at about 1.5-2x its speed. A GenotypePatient step costs the
+    same at any population size already, so leaping cannot gain orders of
+    magnitude over it; the gain over the per-particle engines grows with the
+    population instead.
+    """
+
+    def __init__(self, viruses, maxPop, rng=None, tolerance=0.01,
+                 criticalCount=None, maxLeap=25):
+        """
+        viruses, maxPop, rng: as for GenotypePatient
+
+        tolerance: bounds the change of the population density over a leap
+        (a float, see _leapLength())
+
+        criticalCount: the particle count from which a genotype is treated as
+        abundant (an integer). Defaults to 1 / tolerance, so that one
+        particle is at most a tolerance fraction of an abundant genotype.
+
+        maxLeap: the largest number of time steps covered by one leap (an
+        integer)
+        """
+        GenotypePatient.__init__(self, viruses, maxPop, rng)
+        self.tolerance = tolerance
+        if criticalCount is None:
+            criticalCount = int(numpy.ceil(1.0 / tolerance))
+        self.criticalCount = criticalCount
+        self.maxLeap = maxLeap
+
+    def _birthProbs(self, total):
+        """
+        total: a population size at the start of a time step (a number)
+
+        returns: the birth probability of each genotype at the density
+        update() would see after the expected clearance, zero for genotypes
+        blocked by the prescriptions (an array of floats)
+        """
+        self.popDensity = total * (1 - self.clearProb) / float(self.maxPop)
+        birthProb = min(max(self.maxBirthProb * (1 - self.popDensity), 0.0),
+                        1.0)
+        return numpy.where(self.eligible, birthProb, 0.0)
+
+    def _leapLength(self, birthProbs, remaining):
+        """
+        The approximations of a leap (mutants moved in bulk, fluctuations
+        damped linearly) hold while the population stays close to its
+        expected path. A density drift over a leap of L steps changes the
+        birth probability by survival * maxBirthProb times the drift, which
+        compounds over about L / 2 steps. The leap is the longest one keeping
+        that below tolerance, and shorter than the relaxation time of the
+        density regulation. Longer leaps measurably bias treated arms.
+
+        returns: how many time steps the next leap may cover (an integer)
+        """
+        survival = 1 - self.clearProb
+        total = float(self.getTotalPop())
+        growth = survival * (1 + birthProbs)
+        leaps = numpy.arange(1, min(self.maxLeap, remaining) + 1)
+        predicted = (self.counts * growth ** leaps[:, numpy.newaxis]).sum(1)
+        drift = numpy.abs(predicted - total) / self.maxPop
+        error = survival * self.maxBirthProb * drift * leaps / 2.0
+        within = leaps[error <= self.tolerance]
+        leap = int(within[-1]) if len(within) else 1
+        relaxation = survival ** 2 * self.maxBirthProb * total / self.maxPop
+        if relaxation * leap > 1:
+            leap = int(1 / relaxation)
+        return max(1, leap)
+
+    def _birthPath(self, leap):
+        """
+        Follows the expected population through a leap one time step at a
+        time, as update() would move it on average.
+
+        returns: the birth probability of each genotype at each step of the
+        leap, zero for genotypes blocked by the prescriptions (an array of
+        leap x genotypes floats)
+        """
+        survival = 1 - self.clearProb
+        eligible = self.eligible
+        expected = self.counts.astype(float)
+        blocked = expected[~eligible].sum()
+        growing = expected[eligible].sum()
+        probs = numpy.empty(leap)
+        for step in range(leap):
+            # blocked genotypes only decay, eligible ones share a growth rate
+            density = (blocked + growing) * survival / self.maxPop
+            probs[step] = min(max(self.maxBirthProb * (1 - density), 0.0),
+                              1.0)
+            blocked *= survival
+            growing *= survival * (1 + probs[step])
+        return numpy.outer(probs, eligible)
+
+    def _leap(self, path, abundant):
+        """
+        Advances the population by len(path) time steps, along the birth
+        probabilities of the expected population.
+
+        path: the birth probability of each genotype at each step, as
+        returned by _birthPath()
+
+        abundant: which genotypes are integrated approximately (a boolean
+        array)
+        """
+        rng = self.rng
+        leap = len(path)
+        survival = 1 - self.clearProb
+        counts = self.counts
+
+        # abundant genotypes: a branching process whose offspring mean m and
+        # variance v change every step. After the leap its mean is
+        # n * prod(m), where the mean at step t is E[t]. A fluctuation born at
+        # step t is damped by density regulation over the following steps: in
+        # update() each extra particle lowers the birth probability, so it
+        # adds a = m - survival**2 * maxBirthProb * E[t] / maxPop particles
+        # to the next step rather than m. The variance after the leap is the
+        # sum over t of E[t] * v[t] * damping[t] ** 2, where damping[t] is
+        # the product of a over the steps after t.
+        b = path[:, abundant]
+        m = survival * (1 + b)
+        v = survival * (1 + 3 * b) - m ** 2
+        means = counts[abundant] * numpy.vstack(
+            [numpy.ones(b.shape[1]), numpy.cumprod(m, axis=0)])
+        regulated = (b > 0) & (b < 1)
+        a = m - regulated * (survival ** 2 * self.maxBirthProb * means[:-1] /
+                             self.maxPop)
+        damping = numpy.cumprod(a[::-1], axis=0)[::-1]
+        damping = numpy.vstack([damping[1:], numpy.ones(b.shape[1])])
+        variance = (means[:-1] * v * damping ** 2).sum(0)
+        growth = numpy.cumprod(m[::-1], axis=0)[::-1]
+        growth = numpy.vstack([growth[1:], numpy.ones(b.shape[1])])
+        bornPerStep = means[:-1] * survival * b
+        approx = numpy.rint(rng.normal(means[-1], numpy.sqrt(variance)))
+
+        # their offspring over the leap, of which the mutants move genotype.
+        # Mutants are born in proportion to the expected births of each step.
+        # Those arriving at, or leaving, an abundant genotype would have grown
+        # with it for the rest of the leap, so its net flux is scaled by its
+        # mean growth after such an arrival time.
+        timing = bornPerStep.sum(1)
+        if timing.sum() > 0:
+            timing = timing / timing.sum()
+        else:
+            timing = numpy.full(leap, 1.0 / leap)
+        births = numpy.zeros(len(counts), dtype=numpy.int64)
+        births[abundant] = numpy.rint(bornPerStep.sum(0))
+        flux = self._mutate(births) - births
+        counts = counts.copy()
+        counts[abundant] = numpy.maximum(approx, 0)
+        counts[abundant] += numpy.rint(flux[abundant] *
+                                       timing.dot(growth)).astype(numpy.int64)
+
+        # rare genotypes: exact steps, with the mutants arriving as timed
+        rare = numpy.flatnonzero(~abundant & ((counts > 0) | (flux > 0)))
+        arrivals = rng.multinomial(numpy.maximum(flux[rare], 0), timing)
+        count = counts[rare]
+        rareBirths = numpy.zeros(len(counts), dtype=numpy.int64)
+        for step in range(leap if len(rare) else 0):
+            count = rng.binomial(count, survival)
+            children = rng.binomial(count, path[step, rare])
+            # mutants born this step join after it, as in update()
+            count = count + children + arrivals[:, step]
+            rareBirths[rare] += children
+        counts[rare] = count
+        counts += self._mutate(rareBirths) - rareBirths
+        self.counts = numpy.maximum(counts, 0)
+
+    def advance(self, steps):
+        """
+        Advances the population by a number of time steps, leaping over
+        several steps at a time where the approximation error stays within
+        tolerance and taking exact update() steps elsewhere. Prescriptions
+        must not change during the call.
+
+        steps: the number of time steps to simulate (an integer)
+
+        returns: the total virus population at the end (an integer)
+        """
+        remaining = steps
+        while remaining > 0 and self.getTotalPop() > 0:
+            abundant = self.counts >= self.criticalCount
+            if not abundant.any():
+                self.update()
+                remaining -= 1
+                continue
+            birthProbs = self._birthProbs(self.getTotalPop())
+            leap = self._leapLength(birthProbs, remaining)
+            if leap == 1:
+                self.update()
+            else:
+                self._leap(self._birthPath(leap), abundant)
+            remaining -= leap
+        return self.getTotalPop()
+
+
+#
+# PROBLEM 4
+#
+
+@contextlib.contextmanager
+def _recordingPath(recordPath, name):
+    """
+    Context manager for where a problem driver records its trajectory.
+
+    recordPath: the recording path without extension (a string), or None to
+    record to a temporary directory that is removed on exit
+
+    name: the recording name used inside the temporary directory (a string)
+
+    yields: the recording path to use (a string)
+    """
+    if recordPath is not None:
+        yield recordPath
+        return
+    directory = tempfile.mkdtemp()
+    try:
+        yield os.path.join(directory, name)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def problem4(recordPath=None):
     """
     Runs simulations and plots graphs for problem 4.
 
@@ -389,43 +2140,35 @@ def problem4():
 
     total virus population vs. time  and guttagonol-resistant virus population
     vs. time are plotted
+
+    recordPath: where the populations are recorded after every step (a
+    recorder path without extension, see recorder.TrajectoryRecorder); a
+    temporary recording is used when omitted
     """
     virusesList = []
     maxBirthProb = 0.1
     clearProb = 0.05
     resistance = {'guttagonol':False}
     mutProb = 0.005
-    resistantPop = []
     for x in range(0, 100):
         virusesList.append(ResistantVirus(maxBirthProb , clearProb, resistance, mutProb))
     patient = Patient(virusesList, 1000)
-    populationList = []
-    for x in range(0,300):
-        if x == 150:
-            patient.addPrescription('guttagonol')
-        populationList.append(patient.update())
-        resistantPop.append(patient.getResistPop(['guttagonol']))
-    
-        
-    print resistantPop
-    virusLine = plt.plot(list(range(0, 300)),
-                         populationList,
-                         label='Virus population'
-                         )
-    drugResistantLine = plt.plot(list(range(0, 300)),
-                                 resistantPop,
-                                 label='Drug resistant virus'
-                                 )
-    plt.legend([virusLine, drugResistantLine])
-    plt.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
-           ncol=2, mode="expand", borderaxespad=0.)
-    #plt.title('Virus and drug resistant population VS Time')
-    plt.xlabel('Time steps')
-    plt.ylabel('virus population')
-    plt.grid()
-    plt.show()
-
-problem4()
+    with _recordingPath(recordPath, 'problem4') as path:
+        with recorder.TrajectoryRecorder(path, [['guttagonol']]) as steps:
+            for x in range(0,300):
+                if x == 150:
+                    patient.addPrescription('guttagonol')
+                patient.update()
+                steps.record(patient, x)
+        trajectories = recorder.loadTrajectories(path)
+        resistantPop = numpy.array(trajectories.getColumn('guttagonol'))
+        populationList = numpy.array(trajectories.getColumn('total'))
+        del trajectories
+    print(resistantPop.tolist())
+    import plots
+    plots.plotTimeSeries([(populationList, 'Virus population'),
+                          (resistantPop, 'Drug resistant virus')])
+
 #
 # PROBLEM 5
 #
@@ -440,9 +2183,12 @@ def problem5(numberOfPatients, delay):
     Histograms of final total virus populations are displayed for delays of 300,
     150, 75, 0 timesteps (followed by an additional 150 timesteps of
     simulation).    
+
+    Only running statistics of the outcomes are kept (see aggregate), every
+    patient is dropped as soon as its run is over.
     """
-    curedPatients = []
-    virusCount = []
+    statistics = aggregate.CohortStatistics(numpy.linspace(0, 1000, 11),
+                                            cureThreshold=50)
     for patient in range(1, numberOfPatients):
         virusesList = []
         maxBirthProb = 0.1
@@ -458,20 +2204,16 @@ def problem5(numberOfPatients, delay):
             patient.update()
             #print patient.getTotalPop()
         
-        virusCount.append(patient.getTotalPop())
-        if patient.getTotalPop() <= 50:
-            curedPatients.append(patient)
+        statistics.add(patient.getTotalPop())
     #bins = numpy.linspace(-10, 1000, 10)
-    healedPercent = len(curedPatients)
-    print 'total cured patients is ', healedPercent
-    plt.figure()
-    plt.hist(virusCount)
-    plt.title('Treatment at %s and followed by 150 steps' %delay)
-    plt.xlabel('Total virus population, Percentage cured patients is %s ' % healedPercent)
-    plt.ylabel('Total patients')
-    plt.show()
-
-#problem5(100, 300)
+    healedPercent = statistics.curedCount
+    print('total cured patients is ', healedPercent)
+    counts, edges = statistics.getHistogram()
+    import plots
+    plots.plotHistogram(edges[:-1],
+                        'Treatment at %s and followed by 150 steps' %delay,
+                        'Total virus population, Percentage cured patients is %s ' % healedPercent,
+                        bins=edges, weights=counts)
 
 #
 # PROBLEM 6
@@ -487,9 +2229,12 @@ def problem6(numberOfPatients, firstDelay, secondDelay):
     Histograms of final total virus populations are displayed for lag times of
     150, 75, 0 timesteps between adding drugs (followed by an additional 150
     timesteps of simulation).
+
+    Only running statistics of the outcomes are kept, as in problem5().
     """
-    curedPatients = []
-    virusCount = []
+    # cured means a final population below 50
+    statistics = aggregate.CohortStatistics(numpy.linspace(0, 1000, 11),
+                                            cureThreshold=49)
     for patient in range(1, numberOfPatients):
         virusesList = []
         maxBirthProb = 0.1
@@ -502,33 +2247,29 @@ def problem6(numberOfPatients, firstDelay, secondDelay):
         for x in range(0,firstDelay + secondDelay + 150):
             if x == firstDelay:
                 patient.addPrescription('guttagonol')
-                print 'deoloyed guttagonol to patient blood'
+                print('deoloyed guttagonol to patient blood')
             if x == firstDelay + secondDelay:
                 patient.addPrescription('gimpex')
-                print 'deoloyed gimpex to patient blood'
+                print('deoloyed gimpex to patient blood')
             patient.update()
             #print patient.getTotalPop()
         
-        virusCount.append(patient.getTotalPop())
-        if patient.getTotalPop() < 50:
-            curedPatients.append(patient)
-    healedPercent = len(curedPatients)
-    print 'total cured patients is ', healedPercent
-    plt.figure()
-    plt.hist(virusCount)
-    plt.title('At %s (guttagonol), At %s (gimpex) followed by 150 steps' %(firstDelay, firstDelay + secondDelay))
-    plt.xlabel('Total virus population, Percentage cured patients is %s ' % healedPercent)
-    plt.ylabel('Total patients')
-    plt.show()
-
-#problem6(100, 150, 0)
+        statistics.add(patient.getTotalPop())
+    healedPercent = statistics.curedCount
+    print('total cured patients is ', healedPercent)
+    counts, edges = statistics.getHistogram()
+    import plots
+    plots.plotHistogram(edges[:-1],
+                        'At %s (guttagonol), At %s (gimpex) followed by 150 steps' %(firstDelay, firstDelay + secondDelay),
+                        'Total virus population, Percentage cured patients is %s ' % healedPercent,
+                        bins=edges, weights=counts)
 
 
 #
 # PROBLEM 7
 #
      
-def problem7(firstDelay, secondDelay):
+def problem7(firstDelay, secondDelay, recordPath=None):
     """
     Run simulations and plot graphs examining the relationship between
     administration of multiple drugs and patient outcome.
@@ -536,11 +2277,10 @@ def problem7(firstDelay, secondDelay):
     Plots of total and drug-resistant viruses vs. time are made for a
     simulation with a 300 time step delay between administering the 2 drugs and
     a simulations for which drugs are administered simultaneously.        
-    """
-    guttagonolResistance = []
-    gimpexResistance = []
-    virusCount = []
 
+    recordPath: where the populations are recorded after every step, as for
+    problem4()
+    """
     virusesList = []
     maxBirthProb = 0.1
     clearProb = 0.05
@@ -549,33 +2289,79 @@ def problem7(firstDelay, secondDelay):
     for x in range(0, 100):
         virusesList.append(ResistantVirus(maxBirthProb , clearProb, resistance, mutProb))
     patient = Patient(virusesList, 1000)
-    for x in range(0,firstDelay + secondDelay + 150):
-        if x == firstDelay:
-            patient.addPrescription('guttagonol')
-            print 'deoloyed guttagonol to patient blood'
-        if x == firstDelay + secondDelay:
-            patient.addPrescription('gimpex')
-            print 'deoloyed gimpex to patient blood'
-        patient.update()
-        virusCount.append(patient.getTotalPop())
-        guttagonolResistance.append(patient.getResistPop(['guttagonol']))
-        gimpexResistance.append(patient.getResistPop(['gimpex']))
-    plt.figure()
-    virusLine, = plt.plot(list(range(0, firstDelay + secondDelay + 150)),
-                          virusCount,
-                          label='Total virus')
-    guttagonolLine, = plt.plot(list(range(0, firstDelay + secondDelay + 150)),
-             guttagonolResistance,
-             label='Guttagonol resistant virus')
-    gimpexLine, = plt.plot(list(range(0, firstDelay + secondDelay + 150)),
-             gimpexResistance,
-             label='Gimpex resistant virus'
-             )
-    plt.legend([virusLine, guttagonolLine, gimpexLine])
-    plt.legend(bbox_to_anchor=(0., 1.02, 1., .102), loc=3,
-           ncol=2, mode="expand", borderaxespad=0.)
-    #plt.title('Virus population VS time')
-    plt.ylabel('Total virus population')
-    plt.xlabel('Time steps')
-    plt.show()
-#problem7(150, 0)
+    with _recordingPath(recordPath, 'problem7') as path:
+        with recorder.TrajectoryRecorder(path, [['guttagonol'],
+                                                ['gimpex']]) as steps:
+            for x in range(0,firstDelay + secondDelay + 150):
+                if x == firstDelay:
+                    patient.addPrescription('guttagonol')
+                    print('deoloyed guttagonol to patient blood')
+                if x == firstDelay + secondDelay:
+                    patient.addPrescription('gimpex')
+                    print('deoloyed gimpex to patient blood')
+                patient.update()
+                steps.record(patient, x)
+        trajectories = recorder.loadTrajectories(path)
+        virusCount = numpy.array(trajectories.getColumn('total'))
+        guttagonolResistance = numpy.array(
+            trajectories.getColumn('guttagonol'))
+        gimpexResistance = numpy.array(trajectories.getColumn('gimpex'))
+        del trajectories
+    import plots
+    plots.plotTimeSeries([(virusCount, 'Total virus'),
+                          (guttagonolResistance, 'Guttagonol resistant virus'),
+                          (gimpexResistance, 'Gimpex resistant virus')],
+                         ylabel='Total virus population', grid=False)
+
+
+#
+# COMMAND LINE
+#
+
+def main(argv=None):
+    """
+    Command line entry point: runs one of the problem drivers, e.g.
+
+        python ps12.py problem5 100 300
+
+    argv: the arguments (a list of strings); sys.argv[1:] when omitted
+    """
+    parser = argparse.ArgumentParser(
+        description='Simulate drug effects on virus populations in patients.')
+    problems = parser.add_subparsers(dest='problem')
+    problems.required = True
+    problems.add_parser('problem2', help='untreated patient, 300 steps')
+    parser4 = problems.add_parser(
+        'problem4', help='guttagonol after 150 steps, 150 more steps')
+    parser4.add_argument('--record', metavar='PATH',
+                         help='keep the recorded trajectory at PATH')
+    parser5 = problems.add_parser('problem5',
+                                  help='histogram of delayed guttagonol')
+    parser5.add_argument('numberOfPatients', type=int)
+    parser5.add_argument('delay', type=int)
+    parser6 = problems.add_parser('problem6',
+                                  help='histogram of guttagonol then gimpex')
+    parser6.add_argument('numberOfPatients', type=int)
+    parser6.add_argument('firstDelay', type=int)
+    parser6.add_argument('secondDelay', type=int)
+    parser7 = problems.add_parser('problem7',
+                                  help='resistance dynamics with two drugs')
+    parser7.add_argument('firstDelay', type=int)
+    parser7.add_argument('secondDelay', type=int)
+    parser7.add_argument('--record', metavar='PATH',
+                         help='keep the recorded trajectory at PATH')
+    args = parser.parse_args(argv)
+    if args.problem == 'problem2':
+        problem2()
+    elif args.problem == 'problem4':
+        problem4(args.record)
+    elif args.problem == 'problem5':
+        problem5(args.numberOfPatients, args.delay)
+    elif args.problem == 'problem6':
+        problem6(args.numberOfPatients, args.firstDelay, args.secondDelay)
+    elif args.problem == 'problem7':
+        problem7(args.firstDelay, args.secondDelay, args.record)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+"""
+Streaming recorder for patient trajectories.
+
+A TrajectoryRecorder is handed a patient (or a ps12.PatientBatch) once per time
+step and stores one row per patient: the patient id, the step, the total
+population and the resistant population for each configured drug combination.
+Rows are collected in a preallocated NumPy buffer and appended to a raw binary
+file whenever the buffer fills up, so a long many-patient run never holds its
+trajectories in memory. A small JSON file next to the data describes the
+columns; loadTrajectories() memory-maps the data back for analysis.
+
+For a recording at path 'run', the files are 'run.bin' (little-endian int64
+rows) and 'run.json' (metadata).
+
+A PhaseProfiler is written the same way, but its rows hold the wall time spent
+in each phase of an instrumented patient's update() and the number of events
+it processed (see ps12 setProfiler()), so a profile can be stored and loaded
+next to the trajectories it was taken with.
+"""
+
+import collections
+import json
+
+import numpy
+
+
+DTYPE = numpy.dtype('<i8')
+
+PHASES = ('clearance', 'density', 'gating', 'reproduction', 'mutation',
+          'extension')
+
+EVENTS = ('clears', 'births', 'mutations')
+
+
+class TrajectoryRecorder(object):
+    """
+    Writes patient time series to disk in fixed-size chunks.
+    """
+
+    def __init__(self, path, resistances=(), chunkSize=4096):
+        """
+        path: the recording path, without extension (a string)
+
+        resistances: the drug combinations whose resistant population is
+        recorded (a sequence of lists of strings, e.g. [['guttagonol'],
+        ['guttagonol', 'gimpex']])
+
+        chunkSize: the number of rows buffered before they are written out (an
+        integer)
+        """
+        self.path = path
+        self.resistances = [list(drugs) for drugs in resistances]
+        self.columns = self._makeColumns()
+        self.buffer = numpy.empty((chunkSize, len(self.columns)), dtype=DTYPE)
+        self.used = 0
+        self.rows = 0
+        self.dataFile = open(path + '.bin', 'wb')
+        self._writeMetadata()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def _makeColumns(self):
+        """
+        returns: the names of the recorded columns (a list of strings)
+        """
+        return ['patient', 'step', 'total'] + \
+               ['+'.join(drugs) for drugs in self.resistances]
+
+    def _writeMetadata(self):
+        """
+        Saves the column layout and the number of rows written so far.
+        """
+        with open(self.path + '.json', 'w') as metaFile:
+            json.dump({'columns': self.columns,
+                       'resistances': self.resistances,
+                       'dtype': DTYPE.str,
+                       'rows': self.rows}, metaFile)
+
+    def recordRows(self, rows):
+        """
+        Appends raw rows, one value per column.
+
+        rows: a 2-D array-like of integers with len(self.columns) columns
+        """
+        rows = numpy.asarray(rows, dtype=DTYPE).reshape(-1, len(self.columns))
+        while len(rows):
+            room = len(self.buffer) - self.used
+            taken = rows[:room]
+            self.buffer[self.used:self.used + len(taken)] = taken
+            self.used += len(taken)
+            rows = rows[room:]
+            if self.used == len(self.buffer):
+                self.flush()
+
+    def record(self, patient, step, patientId=0):
+        """
+        Records the state of a patient after a time step.
+
+        patient: a Patient (or engine subclass), or a ps12.PatientBatch, in
+        which case one row is written per patient of the batch, numbered from
+        patientId.
+
+        step: the time step that was just simulated (an integer)
+
+        patientId: the id stored in the patient column (an integer)
+        """
+        totals = numpy.atleast_1d(patient.getTotalPop())
+        columns = [numpy.arange(patientId, patientId + len(totals)),
+                   numpy.full(len(totals), step),
+                   totals]
+        for drugs in self.resistances:
+            columns.append(numpy.atleast_1d(patient.getResistPop(drugs)))
+        self.recordRows(numpy.column_stack(columns))
+
+    def flush(self):
+        """
+        Writes the buffered rows to disk and empties the buffer.
+        """
+        if self.used:
+            self.dataFile.write(self.buffer[:self.used].tobytes())
+            self.rows += self.used
+            self.used = 0
+        self.dataFile.flush()
+        self._writeMetadata()
+
+    def close(self):
+        """
+        Flushes the remaining rows and closes the data file.
+        """
+        if not self.dataFile.closed:
+            self.flush()
+            self.dataFile.close()
+
+
+class PhaseProfiler(TrajectoryRecorder):
+    """
+    Writes the per-phase wall time (in nanoseconds, one '<phase>Ns' column per
+    phase in PHASES) and event counts (one column per event in EVENTS) of
+    every update() of the patients it is attached to, one row per patient and
+    step. Steps are numbered per patient from the first profiled update().
+    """
+
+    def __init__(self, path, chunkSize=4096):
+        """
+        path: the recording path, without extension (a string)
+
+        chunkSize: the number of rows buffered before they are written out (an
+        integer)
+        """
+        self.steps = collections.Counter()
+        self.totals = collections.Counter()
+        TrajectoryRecorder.__init__(self, path, (), chunkSize)
+
+    def _makeColumns(self):
+        return ['patient', 'step'] + [phase + 'Ns' for phase in PHASES] + \
+               list(EVENTS)
+
+    def addStep(self, patientId, times, counts):
+        """
+        Records one update(). Called by the patients, see ps12 setProfiler().
+
+        patientId: the id of the patient, or of the first patient of a batch
+        (an integer)
+
+        times: the wall time of each phase (a dictionary mapping the names in
+        PHASES to nanoseconds). For a batch, every patient's row gets an equal
+        share of it.
+
+        counts: the number of events of each kind (a dictionary mapping the
+        names in EVENTS to an integer, or to an array of one integer per
+        patient of a batch)
+        """
+        counts = [numpy.atleast_1d(counts.get(event, 0)) for event in EVENTS]
+        patients = max(len(count) for count in counts)
+        step = self.steps[patientId]
+        self.steps[patientId] += 1
+        columns = [numpy.arange(patientId, patientId + patients),
+                   numpy.full(patients, step)]
+        for phase in PHASES:
+            columns.append(numpy.full(patients, times.get(phase, 0) // patients))
+            self.totals[phase] += times.get(phase, 0)
+        for event, count in zip(EVENTS, counts):
+            columns.append(numpy.broadcast_to(count, (patients,)))
+            self.totals[event] += int(count.sum())
+        self.recordRows(numpy.column_stack(columns))
+
+    def getTotals(self):
+        """
+        returns: the total seconds spent in each phase and the total number of
+        each event over everything profiled so far (a dictionary keyed by the
+        names in PHASES and EVENTS)
+        """
+        totals = dict((phase, self.totals[phase] / 1e9) for phase in PHASES)
+        for event in EVENTS:
+            totals[event] = self.totals[event]
+        return totals
+
+
+class Trajectories(object):
+    """
+    Read-only, memory-mapped view of a recording.
+    """
+
+    def __init__(self, path):
+        """
+        path: the recording path, without extension (a string)
+        """
+        with open(path + '.json') as metaFile:
+            meta = json.load(metaFile)
+        self.columns = meta['columns']
+        self.resistances = meta['resistances']
+        shape = (meta['rows'], len(self.columns))
+        if meta['rows']:
+            self.data = numpy.memmap(path + '.bin', dtype=meta['dtype'],
+                                     mode='r', shape=shape)
+        else:
+            self.data = numpy.empty(shape, dtype=meta['dtype'])
+
+    def getColumn(self, name):
+        """
+        returns: every recorded value of a column (a 1-D array). Resistance
+        columns are named by their drugs joined with '+'.
+        """
+        return self.data[:, self.columns.index(name)]
+
+    def getPatientIds(self):
+        """
+        returns: the sorted ids of the recorded patients (an array)
+        """
+        return numpy.unique(self.getColumn('patient'))
+
+    def getPatient(self, patientId):
+        """
+        returns: the rows recorded for one patient, in step order (a 2-D
+        array with the recording's columns)
+        """
+        rows = self.data[self.getColumn('patient') == patientId]
+        return rows[numpy.argsort(rows[:, self.columns.index('step')],
+                                  kind='stable')]
+
+
+def loadTrajectories(path):
+    """
+    returns: the Trajectories stored at path (without extension)
+    """
+    return Trajectories(path)
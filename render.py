@@ -0,0 +1,204 @@
+"""
+Headless rendering of stored results to PNG files.
+
+The problem drivers in ps12 draw one figure per run and block on plt.show().
+This module instead renders results that are already on disk, with
+matplotlib's non-interactive Agg backend and across a process pool:
+
+- every cell of a sweep.ResultCache directory becomes a histogram of its final
+  populations, titled like the problem5 and problem6 histograms;
+- every recorder.TrajectoryRecorder recording becomes a time series of the
+  total and resistant populations, averaged over its patients step by step
+  (a one-patient recording is plotted as is, like problem4 and problem7).
+
+Each job reads its own input, so only file names are sent to the workers.
+
+    python render.py --cache .sweepcache --recordings run1 run2 --output figures
+"""
+
+import argparse
+import glob
+import json
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy
+
+import cohort
+import plots
+import recorder
+
+
+def describeSchedule(schedule):
+    """
+    returns: a title for a treatment schedule given as [step, drugs] pairs,
+    e.g. 'At 150 (guttagonol), At 225 (gimpex)', or 'No treatment'
+    """
+    if not schedule:
+        return 'No treatment'
+    return ', '.join('At %d (%s)' % (step, ' + '.join(drugs))
+                     for step, drugs in schedule)
+
+
+def histogramName(record, key):
+    """
+    returns: the file name of a cached cell's histogram (a string), built from
+    its first treatment, its seed and the start of its cache key, e.g.
+    'cohortAt150-seed0-3fa2c1d0.png'
+    """
+    schedule = record['scenario']['schedule']
+    treatment = 'At%d' % schedule[0][0] if schedule else 'Untreated'
+    return 'cohort%s-seed%s-%s.png' % (treatment, record['seed'], key[:8])
+
+
+def _renderHistogram(job):
+    """
+    Pool worker: renders the histogram of one cached sweep cell.
+
+    job: a (cellPath, outputDirectory) tuple
+
+    returns: the path of the written PNG (a string)
+    """
+    cellPath, outputDirectory = job
+    with open(cellPath) as cellFile:
+        record = json.load(cellFile)
+    parameters = record['scenario']
+    finalPops = numpy.asarray(record['finalPops'])
+    cured = int(numpy.count_nonzero(finalPops <= parameters['cureThreshold']))
+    key = os.path.splitext(os.path.basename(cellPath))[0]
+    path = os.path.join(outputDirectory, histogramName(record, key))
+    schedule = parameters['schedule']
+    lastTreatment = schedule[-1][0] if schedule else 0
+    figure = plots.plotHistogram(
+        finalPops,
+        '%s followed by %d steps' % (describeSchedule(schedule),
+                                     parameters['steps'] - lastTreatment),
+        'Total virus population, Percentage cured patients is %.1f'
+        % (100.0 * cured / max(len(finalPops), 1)),
+        show=False, bins=numpy.linspace(0, parameters['maxPop'], 11))
+    plots.saveFigure(figure, path)
+    return path
+
+
+def meanTrajectory(trajectories):
+    """
+    Averages a recording over its patients.
+
+    trajectories: a recorder.Trajectories with a 'total' column
+
+    returns: a (steps, means) tuple, where steps is the sorted array of
+    recorded steps and means maps each population column name ('total' and
+    one per resistance) to its mean at every step
+    """
+    steps, index = numpy.unique(trajectories.getColumn('step'),
+                                return_inverse=True)
+    patients = numpy.bincount(index)
+    names = ['total'] + ['+'.join(drugs) for drugs in trajectories.resistances]
+    means = dict((name, numpy.bincount(index,
+                                       weights=trajectories.getColumn(name))
+                  / patients)
+                 for name in names)
+    return steps, means
+
+
+def _renderTrajectory(job):
+    """
+    Pool worker: renders the mean time series of one recording.
+
+    job: a (recordingPath, outputDirectory) tuple, the recording path without
+    extension
+
+    returns: the path of the written PNG (a string)
+    """
+    recordingPath, outputDirectory = job
+    trajectories = recorder.loadTrajectories(recordingPath)
+    means = meanTrajectory(trajectories)[1]
+    patients = len(trajectories.getPatientIds())
+    series = [(means['total'], 'Total virus')]
+    for drugs in trajectories.resistances:
+        series.append((means['+'.join(drugs)],
+                       '%s resistant virus' % ' + '.join(drugs).capitalize()))
+    # the legend sits above the axes, where a title would go
+    ylabel = 'virus population'
+    if patients > 1:
+        ylabel = 'mean virus population of %d patients' % patients
+    figure = plots.plotTimeSeries(series, ylabel=ylabel, show=False)
+    path = os.path.join(outputDirectory,
+                        os.path.basename(recordingPath) + '.png')
+    plots.saveFigure(figure, path)
+    return path
+
+
+def findRecordings(paths):
+    """
+    returns: the recordings among paths (without extension) that hold
+    trajectories, skipping e.g. PhaseProfiler recordings (a list of strings)
+    """
+    found = []
+    for path in paths:
+        path = path[:-len('.json')] if path.endswith('.json') else path
+        with open(path + '.json') as metaFile:
+            if 'total' in json.load(metaFile)['columns']:
+                found.append(path)
+    return found
+
+
+def render(outputDirectory, cacheDirectory=None, recordings=(),
+           processes=None):
+    """
+    Renders every cached sweep cell and every recording to PNG files.
+
+    outputDirectory: where the figures are written (a string); created if
+    missing
+
+    cacheDirectory: a sweep.ResultCache directory whose cells are rendered as
+    histograms (a string, or None)
+
+    recordings: recording paths, without extension, rendered as time series
+    (a sequence of strings)
+
+    processes: the size of the process pool, as for cohort.runCohort()
+
+    returns: the paths of the written figures (a list of strings)
+    """
+    if not os.path.isdir(outputDirectory):
+        os.makedirs(outputDirectory)
+    jobs = []
+    if cacheDirectory is not None:
+        for cellPath in sorted(glob.glob(os.path.join(cacheDirectory,
+                                                      '*.json'))):
+            jobs.append((_renderHistogram, (cellPath, outputDirectory)))
+    for recordingPath in findRecordings(recordings):
+        jobs.append((_renderTrajectory, (recordingPath, outputDirectory)))
+    return cohort._mapJobs(_renderJob, jobs, processes)
+
+
+def _renderJob(job):
+    """
+    Pool worker: runs one (worker, arguments) rendering job.
+    """
+    worker, arguments = job
+    return worker(arguments)
+
+
+def main(argv=None):
+    """
+    Command line entry point, see the module docstring.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--cache', help='sweep cache directory to render')
+    parser.add_argument('--recordings', nargs='*', default=[],
+                        help='trajectory recordings, without extension')
+    parser.add_argument('--output', default='figures')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args(argv)
+    paths = render(args.output, args.cache, args.recordings, args.processes)
+    print('wrote %d figures to %s' % (len(paths), args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
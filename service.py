@@ -0,0 +1,668 @@
+"""
+Local simulation job service.
+
+A JobService keeps one warm pool of worker processes, which have imported the
+simulator and run a patient before the first job arrives, and serves cohort
+jobs to it. A job is a scenario (any cohort.Scenario parameters, with the
+schedule as a dictionary or as [step, drugs] pairs), a cohort size, a seed
+and the name of the client that submitted it. Jobs are split into single
+patients, and patients are handed to the pool round-robin over the clients
+that have work queued, so one analyst's large job does not hold up another's
+small one. Every finished patient updates the job's aggregate.CohortStatistics
+and is published as an event, so progress and partial statistics can be
+followed while the job runs. Patient i of a job always receives the i-th seed
+spawned from the job seed, so a finished job's final populations equal those
+of cohort.runCohort(scenario, patients, seed). A job may ask for at most
+maxPatients patients, and jobs that are over are forgotten after a while.
+
+serve() exposes a service over HTTP on the local machine:
+
+    POST   /jobs              submit a job, e.g. {"scenario": {"steps": 300,
+                              "schedule": {"150": ["guttagonol"]}},
+                              "patients": 100, "seed": 0, "client": "ana"}
+    GET    /jobs              the summaries of all jobs
+    GET    /jobs/<id>         one job's summary and partial statistics
+    GET    /jobs/<id>/events  newline-delimited JSON, one line per finished
+                              patient, until the job is over
+    DELETE /jobs/<id>         cancel the patients that have not started
+
+    python service.py --port 8765 --processes 8 --max-patients 100000
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import math
+import multiprocessing
+import sys
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy
+
+import aggregate
+import cohort
+
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _warmWorker():
+    """
+    Pool initializer: simulates one short patient, so that the first job a
+    worker receives does not pay for imports and first-call setup.
+    """
+    cohort._runPatient((cohort.Scenario(10, engine='genotype'), 0))
+
+
+# the JSON type and range of every Scenario parameter but the schedule;
+# integers also accept whole floats such as 300.0
+PARAMETERS = {'steps': (int, 0, None),
+              'maxBirthProb': (float, 0, 1),
+              'clearProb': (float, 0, 1),
+              'mutProb': (float, 0, 1),
+              'initialViruses': (int, 0, None),
+              'maxPop': (int, 1, None),
+              'cureThreshold': (float, None, None),
+              'steadyWindow': (int, 1, None)}
+
+
+def _checkNumber(name, value, kind, low=None, high=None):
+    """
+    Checks one numeric job field, raising a ValueError unless value is a
+    number of the given kind within [low, high].
+
+    returns: value converted to kind (int or float)
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or \
+            (isinstance(value, float) and not math.isfinite(value)) or \
+            (kind is int and value != int(value)):
+        raise ValueError('%s must be %s' % (name, 'an integer' if kind is int
+                                            else 'a number'))
+    try:
+        value = kind(value)
+    except OverflowError:
+        raise ValueError('%s is out of range' % name)
+    if high is None and low is not None and value < low:
+        raise ValueError('%s must be at least %s' % (name, low))
+    if high is not None and not low <= value <= high:
+        raise ValueError('%s must be between %s and %s' % (name, low, high))
+    return value
+
+
+def _checkDrugs(name, drugs):
+    """
+    Checks a list of drug names, raising a ValueError if it is not one.
+
+    returns: drugs (a list of strings)
+    """
+    if not isinstance(drugs, list) or \
+            not all(isinstance(drug, str) for drug in drugs):
+        raise ValueError('%s must be a list of drug names' % name)
+    return drugs
+
+
+def makeScenario(parameters):
+    """
+    Builds a scenario from a job specification. The type and range of every
+    parameter are checked up front, and a ValueError is raised for a
+    malformed specification, so a bad value is rejected on submission rather
+    than failing the job later.
+
+    parameters: the keyword arguments of cohort.Scenario (a dictionary). The
+    schedule may be a dictionary with integer or string steps, or a list of
+    [step, drugs] pairs as Scenario.getParameters() returns it.
+
+    returns: a cohort.Scenario
+    """
+    if not isinstance(parameters, dict):
+        raise ValueError('the scenario must be a JSON object')
+    parameters = dict(parameters)
+    if 'steps' not in parameters:
+        raise ValueError('the scenario needs a number of steps')
+    for name, value in parameters.items():
+        # a null steadyWindow leaves steady-state stops off
+        if name in PARAMETERS and not (name == 'steadyWindow' and
+                                       value is None):
+            parameters[name] = _checkNumber(name, value, *PARAMETERS[name])
+    if not isinstance(parameters.get('engine', ''), str):
+        raise ValueError('engine must be a string')
+    if 'earlyStop' in parameters and \
+            not isinstance(parameters['earlyStop'], bool):
+        raise ValueError('earlyStop must be true or false')
+    if 'drugs' in parameters:
+        parameters['drugs'] = tuple(_checkDrugs('drugs',
+                                                parameters['drugs']))
+    schedule = parameters.get('schedule') or {}
+    if isinstance(schedule, dict):
+        schedule = list(schedule.items())
+    if not isinstance(schedule, list) or \
+            not all(isinstance(entry, (list, tuple)) and len(entry) == 2
+                    for entry in schedule):
+        raise ValueError('the schedule must map steps to lists of drugs')
+    parameters['schedule'] = {}
+    for step, drugs in schedule:
+        try:
+            step = int(step)
+        except (TypeError, ValueError):
+            raise ValueError('schedule steps must be integers')
+        parameters['schedule'][step] = _checkDrugs('scheduled drugs', drugs)
+    try:
+        return cohort.Scenario(**parameters)
+    except TypeError as error:
+        raise ValueError('invalid scenario: %s' % error)
+
+
+class Job(object):
+    """
+    A cohort submitted to a JobService and its progress.
+    """
+
+    def __init__(self, jobId, client, scenario, numberOfPatients, seed=None):
+        """
+        jobId: the id the job is known by (an integer)
+
+        client: who submitted the job (a string); the service shares its
+        workers fairly between clients
+
+        scenario: the treatment arm to simulate (a cohort.Scenario)
+
+        numberOfPatients: the cohort size (an integer)
+
+        seed: the cohort seed (an integer, or None for fresh entropy)
+        """
+        self.jobId = jobId
+        self.client = client
+        self.scenario = scenario
+        self.numberOfPatients = numberOfPatients
+        self.root = numpy.random.SeedSequence(seed)
+        self.entropy = self.root.entropy
+        self.statistics = aggregate.forScenario(scenario)
+        self.finalPops = [None] * numberOfPatients
+        self.events = []
+        self.nextPatient = 0
+        self.running = 0
+        self.state = 'queued'
+        self.error = None
+        self.overSince = None
+
+    def getSeed(self, index):
+        """
+        Spawns the seed of one patient when it is dispatched, rather than all
+        of them up front.
+
+        returns: the index-th seed spawned from the job seed (a
+        numpy.random.SeedSequence), as cohort.patientSeeds() would return it
+        """
+        root = self.root
+        return numpy.random.SeedSequence(root.entropy,
+                                         spawn_key=root.spawn_key + (index,),
+                                         pool_size=root.pool_size)
+
+    def isPending(self):
+        """
+        returns: True if some patients have not been handed to a worker yet
+        """
+        return self.state in ('queued', 'running') and \
+            self.nextPatient < self.numberOfPatients
+
+    def isOver(self):
+        """
+        returns: True if the job is done, failed or cancelled and no patient
+        of it is still running
+        """
+        return self.state in ('done', 'failed', 'cancelled') and \
+            self.running == 0
+
+    def getStatistics(self):
+        """
+        returns: the partial statistics of the finished patients (a
+        JSON-serializable dictionary)
+        """
+        statistics = self.statistics
+        summary = {'count': statistics.getCount(),
+                   'cureRate': statistics.getCureRate(),
+                   'mean': statistics.getMean(),
+                   'variance': statistics.getVariance()}
+        if statistics.getCount():
+            summary['quantiles'] = dict(
+                (str(q), statistics.getQuantile(q)) for q in QUANTILES)
+        return summary
+
+    def getSummary(self):
+        """
+        returns: the job's parameters, state and partial statistics (a
+        JSON-serializable dictionary)
+        """
+        summary = {'id': self.jobId,
+                   'client': self.client,
+                   'state': self.state,
+                   'scenario': self.scenario.getParameters(),
+                   'patients': self.numberOfPatients,
+                   'completed': self.statistics.getCount(),
+                   'entropy': str(self.entropy),
+                   'statistics': self.getStatistics()}
+        if self.error is not None:
+            summary['error'] = self.error
+        if self.state == 'done':
+            summary['finalPops'] = self.finalPops
+        return summary
+
+
+class JobService(object):
+    """
+    Queue of cohort jobs served by one warm process pool.
+    """
+
+    def __init__(self, processes=None, maxRunning=None, maxPatients=100000,
+                 keepFinished=3600):
+        """
+        processes: the number of worker processes (an integer). Defaults to
+        the number of CPUs.
+
+        maxRunning: how many patients are handed to the pool at once (an
+        integer). Defaults to twice the number of processes, which keeps the
+        workers busy while leaving the rest of the queue to be shared fairly.
+
+        maxPatients: the largest cohort a job may ask for (an integer). A job
+        holds its final populations in memory, so this bounds what a single
+        client can make the service allocate.
+
+        keepFinished: how long a job that is over stays listed, in seconds (a
+        float)
+        """
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.maxRunning = maxRunning or 2 * processes
+        self.maxPatients = maxPatients
+        self.keepFinished = keepFinished
+        self.pool = multiprocessing.Pool(processes, _warmWorker)
+        self.condition = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.queues = collections.OrderedDict()
+        self.jobIds = itertools.count(1)
+        self.running = 0
+        self.closed = False
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def submit(self, scenario, numberOfPatients, seed=None, client='default'):
+        """
+        Queues a cohort.
+
+        scenario: the treatment arm to simulate (a cohort.Scenario)
+
+        numberOfPatients: the cohort size (a positive integer, at most
+        maxPatients)
+
+        seed: the cohort seed (an integer, or None for fresh entropy)
+
+        client: who submitted the job (a string)
+
+        returns: the queued Job
+        """
+        if numberOfPatients < 1:
+            raise ValueError('a job needs at least one patient')
+        if numberOfPatients > self.maxPatients:
+            raise ValueError('a job may have at most %d patients'
+                             % self.maxPatients)
+        # the job's buffers are allocated without blocking the service
+        job = Job(next(self.jobIds), client, scenario, numberOfPatients, seed)
+        with self.condition:
+            if self.closed:
+                raise ValueError('the service is closed')
+            self._expire()
+            self.jobs[job.jobId] = job
+            self.queues.setdefault(client, collections.deque()).append(job)
+            self.condition.notify_all()
+        return job
+
+    def submitSpec(self, spec):
+        """
+        Queues a job described as a dictionary with the keys 'scenario' (see
+        makeScenario()), 'patients', and optionally 'seed' and 'client'.
+
+        Raises a ValueError for a malformed specification, see
+        makeScenario().
+
+        returns: the queued Job
+        """
+        unknown = set(spec) - set(['scenario', 'patients', 'seed', 'client'])
+        if unknown:
+            raise ValueError('unknown job fields: %s'
+                             % ', '.join(sorted(unknown)))
+        if 'scenario' not in spec or 'patients' not in spec:
+            raise ValueError('a job needs a scenario and a number of patients')
+        scenario = makeScenario(spec['scenario'])
+        numberOfPatients = _checkNumber('patients', spec['patients'], int, 1)
+        seed = spec.get('seed')
+        if seed is not None:
+            seed = _checkNumber('seed', seed, int, 0)
+        client = spec.get('client', 'default')
+        if not isinstance(client, str):
+            raise ValueError('client must be a string')
+        return self.submit(scenario, numberOfPatients, seed, client)
+
+    def getJob(self, jobId):
+        """
+        returns: the Job with the given id (an integer), or None
+        """
+        with self.condition:
+            self._expire()
+            return self.jobs.get(jobId)
+
+    def getJobs(self):
+        """
+        returns: every submitted Job that has not expired, in submission order
+        (a list)
+        """
+        with self.condition:
+            self._expire()
+            return list(self.jobs.values())
+
+    def getSummary(self, job):
+        """
+        Reads a job's summary while no patient of it is being recorded.
+
+        returns: see Job.getSummary()
+        """
+        with self.condition:
+            return job.getSummary()
+
+    def getSummaries(self):
+        """
+        returns: the summaries of every job that has not expired, in
+        submission order (a list)
+        """
+        with self.condition:
+            self._expire()
+            return [job.getSummary() for job in self.jobs.values()]
+
+    def cancel(self, jobId):
+        """
+        Cancels a job: its patients that have not started are dropped, the
+        running ones finish and still count towards its statistics.
+
+        returns: the Job, or None if there is no such job
+        """
+        with self.condition:
+            job = self.jobs.get(jobId)
+            if job is not None and job.state in ('queued', 'running'):
+                job.state = 'cancelled'
+                self._publish(job, {'state': 'cancelled'})
+                self._markOver(job)
+            return job
+
+    def events(self, job, timeout=None):
+        """
+        Follows a job's progress, from its first event on.
+
+        timeout: the longest wait for the next event, in seconds (a float, or
+        None to wait as long as the job runs)
+
+        returns: a generator of event dictionaries, one per finished patient
+        (with the keys 'patient', 'finalPop', 'completed' and 'statistics')
+        and one per change of state (with the key 'state'), which ends once
+        the job is over
+        """
+        seen = 0
+        while True:
+            with self.condition:
+                while seen == len(job.events) and not job.isOver():
+                    if not self.condition.wait(timeout):
+                        return
+                new = job.events[seen:]
+                over = job.isOver()
+            for event in new:
+                yield event
+            seen += len(new)
+            if over and seen == len(job.events):
+                return
+
+    def close(self):
+        """
+        Stops dispatching and terminates the workers; running jobs are left
+        unfinished.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.dispatcher.join()
+        self.pool.terminate()
+        self.pool.join()
+
+    def _publish(self, job, event):
+        """
+        Appends an event to a job and wakes its followers. Callers hold the
+        condition.
+        """
+        job.events.append(event)
+        self.condition.notify_all()
+
+    def _markOver(self, job):
+        """
+        Starts the expiry clock of a job once it is over. Callers hold the
+        condition.
+        """
+        if job.isOver() and job.overSince is None:
+            job.overSince = time.monotonic()
+
+    def _expire(self):
+        """
+        Forgets the jobs that have been over for longer than keepFinished.
+        Callers hold the condition.
+        """
+        cutoff = time.monotonic() - self.keepFinished
+        for jobId, job in list(self.jobs.items()):
+            if job.overSince is not None and job.overSince <= cutoff:
+                del self.jobs[jobId]
+
+    def _nextPatient(self):
+        """
+        Picks the next patient to run, taking one from each client in turn.
+        Callers hold the condition.
+
+        returns: a (job, patient index) tuple, or None when nothing is queued
+        """
+        for client in list(self.queues):
+            queue = self.queues.pop(client)
+            while queue and not queue[0].isPending():
+                queue.popleft()
+            if not queue:
+                continue
+            # the client goes to the back of the line
+            self.queues[client] = queue
+            job = queue[0]
+            index = job.nextPatient
+            job.nextPatient += 1
+            if job.state == 'queued':
+                job.state = 'running'
+                self._publish(job, {'state': 'running'})
+            return job, index
+        return None
+
+    def _dispatch(self):
+        """
+        Dispatcher thread: hands patients to the pool while fewer than
+        maxRunning are running.
+        """
+        while True:
+            with self.condition:
+                picked = None
+                while not self.closed:
+                    if self.running < self.maxRunning:
+                        picked = self._nextPatient()
+                        if picked is not None:
+                            break
+                    self.condition.wait()
+                if self.closed:
+                    return
+                job, index = picked
+                job.running += 1
+                self.running += 1
+                seed = job.getSeed(index)
+            self.pool.apply_async(
+                cohort._runPatient, ((job.scenario, seed),),
+                callback=lambda finalPop, job=job, index=index:
+                    self._finish(job, index, finalPop),
+                error_callback=lambda error, job=job:
+                    self._fail(job, error))
+
+    def _finish(self, job, index, finalPop):
+        """
+        Pool callback: records a finished patient.
+        """
+        with self.condition:
+            job.running -= 1
+            self.running -= 1
+            job.finalPops[index] = finalPop
+            job.statistics.add(finalPop)
+            self._publish(job, {'patient': index,
+                                'finalPop': finalPop,
+                                'completed': job.statistics.getCount(),
+                                'statistics': job.getStatistics()})
+            if job.state == 'running' and \
+                    job.statistics.getCount() == job.numberOfPatients:
+                job.state = 'done'
+                self._publish(job, {'state': 'done'})
+            self._markOver(job)
+
+    def _fail(self, job, error):
+        """
+        Pool callback: marks a job failed when one of its patients raised.
+        """
+        with self.condition:
+            job.running -= 1
+            self.running -= 1
+            if job.state in ('queued', 'running'):
+                job.state = 'failed'
+                job.error = '%s: %s' % (type(error).__name__, error)
+                self._publish(job, {'state': 'failed', 'error': job.error})
+            else:
+                self.condition.notify_all()
+            self._markOver(job)
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """
+    HTTP front end of the JobService in self.server.service.
+    """
+
+    def _sendJson(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        """
+        returns: a (job, tail) tuple for paths /jobs/<id>[/tail], where job
+        is None for an unknown id, or None for any other path
+        """
+        parts = self.path.split('?')[0].strip('/').split('/')
+        if len(parts) < 2 or parts[0] != 'jobs' or not parts[1].isdigit():
+            return None
+        return (self.server.service.getJob(int(parts[1])),
+                '/'.join(parts[2:]))
+
+    def do_GET(self):
+        if self.path.split('?')[0].rstrip('/') == '/jobs':
+            self._sendJson(200, self.server.service.getSummaries())
+            return
+        route = self._route()
+        if route is None or route[0] is None or route[1] not in ('',
+                                                                 'events'):
+            self._sendJson(404, {'error': 'not found'})
+            return
+        job, tail = route
+        if tail == '':
+            self._sendJson(200, self.server.service.getSummary(job))
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for event in self.server.service.events(job):
+            self.wfile.write(json.dumps(event).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def do_POST(self):
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            self._sendJson(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            spec = json.loads(self.rfile.read(length).decode('utf-8'))
+            if not isinstance(spec, dict):
+                raise ValueError('a job is a JSON object')
+            job = self.server.service.submitSpec(spec)
+        except (TypeError, ValueError) as error:
+            self._sendJson(400, {'error': str(error)})
+            return
+        self._sendJson(201, self.server.service.getSummary(job))
+
+    def do_DELETE(self):
+        route = self._route()
+        if route is None or route[0] is None or route[1]:
+            self._sendJson(404, {'error': 'not found'})
+            return
+        service = self.server.service
+        job = service.cancel(route[0].jobId)
+        if job is None:
+            self._sendJson(404, {'error': 'not found'})
+            return
+        self._sendJson(200, service.getSummary(job))
+
+    def log_message(self, format, *args):
+        # event streams would flood stderr with one line per request
+        pass
+
+
+def serve(service, host='127.0.0.1', port=8765):
+    """
+    Serves a JobService over HTTP until interrupted.
+
+    host: the address to listen on (a string); the default only accepts
+    connections from this machine
+
+    port: the port to listen on (an integer)
+    """
+    server = ThreadingHTTPServer((host, port), JobHandler)
+    server.daemon_threads = True
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main(argv=None):
+    """
+    Command line entry point, see the module docstring.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--max-patients', type=int, default=100000,
+                        help='the largest cohort a job may ask for')
+    args = parser.parse_args(argv)
+    service = JobService(args.processes, maxPatients=args.max_patients)
+    print('serving simulation jobs on http://%s:%d/jobs'
+          % (args.host, args.port))
+    try:
+        serve(service, args.host, args.port)
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
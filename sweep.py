@@ -0,0 +1,218 @@
+"""
+Parameter sweeps over cohort scenarios, with a persistent result cache.
+
+A sweep is a list of cells, each a (cohort.Scenario, seed) pair; makeCells()
+builds the cross product of values for any Scenario parameter (maxBirthProb,
+clearProb, mutProb, maxPop, schedule, ...) and seeds. runSweep() simulates the
+cells that are not in the cache, spreading all of their patients over one
+process pool, and stores every finished cell in a ResultCache. A cell is keyed
+by a hash of its parameters, cohort size, seed and the source of the
+simulation code, so repeated or overlapping sweeps only compute the cells they
+have not seen, and editing ps12.py or cohort.py invalidates stale results.
+
+    python sweep.py --maxBirthProb 0.1 0.2 --delay 0 75 150 --patients 100
+"""
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import sys
+
+import numpy
+
+import cohort
+
+
+CODE_FILES = ('ps12.py', 'cohort.py')
+
+
+def codeVersion():
+    """
+    returns: a digest of the simulation source files (a string), which
+    changes whenever the simulation code does
+    """
+    digest = hashlib.sha256()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in CODE_FILES:
+        with open(os.path.join(here, name), 'rb') as sourceFile:
+            digest.update(sourceFile.read())
+    return digest.hexdigest()[:16]
+
+
+def makeCells(steps, seeds=(0,), **axes):
+    """
+    Builds the cross product of scenario parameters and seeds.
+
+    steps: the number of time steps of every scenario (an integer)
+
+    seeds: the cohort seeds each parameter combination is run with (a
+    sequence of integers)
+
+    axes: for each Scenario parameter to vary, the list of its values, e.g.
+    maxPop=[1000, 10000] or schedule=[{0: ['guttagonol']}, {75:
+    ['guttagonol']}]. Parameters that are not given keep their defaults.
+
+    returns: a list of (Scenario, seed) tuples
+    """
+    names = sorted(axes)
+    cells = []
+    for values in itertools.product(*[axes[name] for name in names]):
+        scenario = cohort.Scenario(steps, **dict(zip(names, values)))
+        for seed in seeds:
+            cells.append((scenario, seed))
+    return cells
+
+
+class ResultCache(object):
+    """
+    Directory of finished sweep cells, one JSON file per cell.
+    """
+
+    def __init__(self, directory, version=None):
+        """
+        directory: where the cells are stored (a string); created if missing
+
+        version: the code version cells are keyed under (a string). Defaults
+        to codeVersion().
+        """
+        self.directory = directory
+        self.version = version if version is not None else codeVersion()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def getKey(self, scenario, numberOfPatients, seed):
+        """
+        returns: the key of a cell (a hex string)
+        """
+        description = {'scenario': scenario.getParameters(),
+                       'patients': numberOfPatients,
+                       'seed': seed,
+                       'version': self.version}
+        encoded = json.dumps(description, sort_keys=True).encode('utf-8')
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def get(self, key):
+        """
+        returns: the final populations stored under key (a list of integers),
+        or None when the cell has not been computed
+        """
+        try:
+            with open(self._path(key)) as cellFile:
+                return json.load(cellFile)['finalPops']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def put(self, key, result, numberOfPatients):
+        """
+        Stores a finished cell. The file is written under a temporary name and
+        then renamed, so concurrent sweeps never read half a cell.
+
+        result: the cohort.CohortResult of the cell
+        """
+        record = {'scenario': result.scenario.getParameters(),
+                  'patients': numberOfPatients,
+                  'seed': result.seed,
+                  'version': self.version,
+                  'finalPops': result.finalPops.tolist()}
+        path = self._path(key)
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'w') as cellFile:
+            json.dump(record, cellFile)
+        os.replace(temporary, path)
+
+
+def runSweep(cells, numberOfPatients, cache=None, processes=None,
+             chunksize=None):
+    """
+    Simulates every cell of a sweep, reusing cached cells.
+
+    cells: the (Scenario, seed) tuples to run (see makeCells()). Seeds must be
+    integers, so that cells are reproducible.
+
+    numberOfPatients: the cohort size of every cell (an integer)
+
+    cache: where finished cells are looked up and stored (a ResultCache, or
+    None to compute everything)
+
+    processes, chunksize: as for cohort.runCohort(); the patients of all
+    missing cells share one pool
+
+    returns: a list of cohort.CohortResult instances, in cell order. Every
+    result equals what cohort.runCohort(scenario, numberOfPatients, seed)
+    returns.
+    """
+    results = [None] * len(cells)
+    keys = [None] * len(cells)
+    jobs = []
+    missing = []
+    for i, (scenario, seed) in enumerate(cells):
+        if seed is None:
+            raise ValueError('sweep cells need integer seeds')
+        if cache is not None:
+            keys[i] = cache.getKey(scenario, numberOfPatients, seed)
+            finalPops = cache.get(keys[i])
+            if finalPops is not None:
+                results[i] = cohort.CohortResult(scenario, seed, finalPops)
+                continue
+        entropy, seeds = cohort.patientSeeds(seed, numberOfPatients)
+        jobs.extend((scenario, s) for s in seeds)
+        missing.append(i)
+    finalPops = cohort._mapJobs(cohort._runPatient, jobs, processes,
+                                chunksize)
+    for n, i in enumerate(missing):
+        scenario, seed = cells[i]
+        results[i] = cohort.CohortResult(
+            scenario, seed,
+            finalPops[n * numberOfPatients:(n + 1) * numberOfPatients])
+        if cache is not None:
+            cache.put(keys[i], results[i], numberOfPatients)
+    return results
+
+
+def main(argv=None):
+    """
+    Command line entry point: sweeps problem5-style arms (guttagonol after
+    each delay, then 150 more steps) and prints one line per cell.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--maxBirthProb', type=float, nargs='+', default=[0.1])
+    parser.add_argument('--clearProb', type=float, nargs='+', default=[0.05])
+    parser.add_argument('--mutProb', type=float, nargs='+', default=[0.005])
+    parser.add_argument('--maxPop', type=int, nargs='+', default=[1000])
+    parser.add_argument('--delay', type=int, nargs='+', default=[0])
+    parser.add_argument('--seed', type=int, nargs='+', default=[0])
+    parser.add_argument('--patients', type=int, default=100)
+    parser.add_argument('--engine', choices=sorted(cohort.ENGINES),
+                        default='genotype')
+    parser.add_argument('--processes', type=int)
+    parser.add_argument('--cache', default='.sweepcache',
+                        help='cache directory ("" disables the cache)')
+    args = parser.parse_args(argv)
+    cells = []
+    for delay in args.delay:
+        cells.extend(makeCells(delay + 150, args.seed,
+                               maxBirthProb=args.maxBirthProb,
+                               clearProb=args.clearProb,
+                               mutProb=args.mutProb,
+                               maxPop=args.maxPop,
+                               schedule=[{delay: ['guttagonol']}],
+                               engine=[args.engine]))
+    cache = ResultCache(args.cache) if args.cache else None
+    results = runSweep(cells, args.patients, cache, args.processes)
+    for result in results:
+        scenario = result.scenario
+        print('maxBirthProb=%g clearProb=%g mutProb=%g maxPop=%d delay=%d '
+              'seed=%d: cured %.3f, mean final population %.1f'
+              % (scenario.maxBirthProb, scenario.clearProb, scenario.mutProb,
+                 scenario.maxPop, scenario.getFirstTreatment(), result.seed,
+                 result.getCureRate(), numpy.mean(result.finalPops)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,320 @@
+"""
+Regression tests for ps12.
+
+    python -m pytest test_ps12.py
+"""
+
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+import numpy
+
+import aggregate
+import cohort
+import ps12
+import service
+
+
+class ClearanceTest(unittest.TestCase):
+    """
+    _clearViruses() must clear each particle with probability clearProb,
+    whichever way it removes the cleared ones.
+    """
+
+    population = 100000
+    clearProb = 0.05
+
+    def _clear(self, swapRemove, seed):
+        """
+        Runs one clearance pass over a fresh population.
+
+        returns: a (viruses, cleared, survivors) tuple of lists
+        """
+        viruses = [ps12.SimpleVirus(0.1, self.clearProb)
+                   for i in range(self.population)]
+        patient = ps12.SimplePatient(list(viruses), self.population,
+                                     swapRemove=swapRemove, rng=seed)
+        cleared = patient._clearViruses()
+        return viruses, cleared, patient.viruses
+
+    def _checkRate(self, swapRemove):
+        for seed in range(3):
+            viruses, cleared, survivors = self._clear(swapRemove, seed)
+            # every particle is either cleared or survives, exactly once
+            self.assertEqual(len(cleared) + len(survivors), len(viruses))
+            self.assertEqual(set(map(id, cleared)) | set(map(id, survivors)),
+                             set(map(id, viruses)))
+            # the cleared count is Binomial(population, clearProb)
+            expected = self.population * self.clearProb
+            deviation = math.sqrt(expected * (1 - self.clearProb))
+            self.assertLess(abs(len(cleared) - expected), 4 * deviation)
+
+    def testListRemoval(self):
+        self._checkRate(swapRemove=False)
+
+    def testSwapRemoval(self):
+        self._checkRate(swapRemove=True)
+
+    def testSwapRemovalOverSteps(self):
+        # swapped-in particles must not skip their draw, which would show as
+        # a low clearance rate over several steps
+        viruses = [ps12.SimpleVirus(0.1, self.clearProb)
+                   for i in range(self.population)]
+        patient = ps12.SimplePatient(viruses, self.population,
+                                     swapRemove=True, rng=7)
+        steps = 5
+        for step in range(steps):
+            patient._clearViruses()
+        survival = (1 - self.clearProb) ** steps
+        expected = self.population * survival
+        deviation = math.sqrt(expected * (1 - survival))
+        self.assertLess(abs(patient.getTotalPop() - expected), 4 * deviation)
+
+
+class CheckpointTest(unittest.TestCase):
+    """
+    Snapshots and checkpoints must continue exactly as the patient they were
+    taken from, on every engine.
+    """
+
+    drugs = ('guttagonol', 'grimpex')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _patients(self):
+        """
+        returns: (engine, patient) pairs, each patient treated with
+        guttagonol after 60 of its 100 time steps so far
+        """
+        patients = []
+        for engine in sorted(cohort.ENGINES):
+            scenario = cohort.Scenario(100, drugs=self.drugs, engine=engine)
+            patients.append((engine, scenario.makePatient(
+                numpy.random.default_rng(5))))
+        viruses = cohort.Scenario(100, drugs=self.drugs).makeViruses()
+        patients.append(('batch', ps12.PatientBatch(viruses, 1000, 4, rng=5)))
+        for engine, patient in patients:
+            for step in range(100):
+                if step == 60:
+                    patient.addPrescription('guttagonol')
+                patient.update()
+        return patients
+
+    def _trajectory(self, patient, steps=40):
+        """
+        returns: the total and resistant populations after each of steps
+        further time steps (a list)
+        """
+        trajectory = []
+        for step in range(steps):
+            trajectory.append(numpy.asarray(patient.update()).tolist())
+            trajectory.append([numpy.asarray(patient.getResistPop([drug]))
+                               .tolist() for drug in self.drugs])
+        return trajectory
+
+    def testSnapshot(self):
+        for engine, patient in self._patients():
+            snapshot = patient.snapshot()
+            self.assertEqual(self._trajectory(snapshot),
+                             self._trajectory(patient), msg=engine)
+
+    def testSaveAndLoad(self):
+        for engine, patient in self._patients():
+            path = os.path.join(self.directory, engine)
+            patient.save(path)
+            loaded = ps12.loadCheckpoint(path)
+            self.assertEqual(self._trajectory(loaded),
+                             self._trajectory(patient), msg=engine)
+
+    def testLoadWithOtherDrugBits(self):
+        # a fresh process that numbers the drugs differently in DRUGS
+        script = (
+            'import json, sys\n'
+            'import ps12\n'
+            'ps12.DRUGS.getMask(["placebo", "grimpex", "guttagonol"])\n'
+            'patient = ps12.loadCheckpoint(sys.argv[1])\n'
+            'assert patient.prescriptionMask == '
+            'ps12.DRUGS.getMask(["guttagonol"])\n'
+            'trajectory = []\n'
+            'for step in range(40):\n'
+            '    trajectory.append(int(patient.update()))\n'
+            '    trajectory.append([patient.getResistPop([drug])\n'
+            '                       for drug in ("guttagonol", "grimpex")])\n'
+            'print(json.dumps(trajectory))\n')
+        here = os.path.dirname(os.path.abspath(__file__))
+        for engine, patient in self._patients():
+            if engine == 'batch':
+                # a PatientBatch numbers drugs by its own drugNames
+                continue
+            path = os.path.join(self.directory, engine)
+            patient.save(path)
+            output = subprocess.check_output([sys.executable, '-c', script,
+                                              path], cwd=here)
+            self.assertEqual(json.loads(output), self._trajectory(patient),
+                             msg=engine)
+
+
+class StatisticsTest(unittest.TestCase):
+    """
+    Streamed and merged CohortStatistics must summarize the same patients as
+    runCohort() and a single pass over all of them.
+    """
+
+    def _assertSame(self, statistics, finalPops, cureThreshold=50):
+        finalPops = numpy.asarray(finalPops, dtype=float)
+        self.assertEqual(statistics.getCount(), len(finalPops))
+        self.assertAlmostEqual(statistics.getCureRate(),
+                               numpy.mean(finalPops <= cureThreshold))
+        self.assertAlmostEqual(statistics.getMean(), finalPops.mean())
+        self.assertAlmostEqual(statistics.getVariance(),
+                               finalPops.var(ddof=1), delta=1e-6 *
+                               finalPops.var(ddof=1))
+
+    def testStreamingMatchesRunCohort(self):
+        scenario = cohort.delayedTreatment(75, engine='genotype')
+        finalPops = cohort.runCohort(scenario, 40, seed=11,
+                                     processes=1).finalPops
+        for processes in (1, 2):
+            statistics = cohort.runStreaming(scenario, 40, seed=11,
+                                             processes=processes,
+                                             chunksize=3)
+            self._assertSame(statistics, finalPops)
+
+    def testMergeMatchesOnePass(self):
+        values = numpy.random.default_rng(1).integers(0, 1000, 501)
+        edges = numpy.linspace(0, 1000, 21)
+        whole = aggregate.CohortStatistics(edges)
+        whole.add(values)
+        merged = aggregate.CohortStatistics(edges)
+        for half in (values[:200], values[200:]):
+            part = aggregate.CohortStatistics(edges)
+            for value in half:
+                part.add(value)
+            merged.merge(part)
+        self._assertSame(merged, values)
+        self.assertAlmostEqual(merged.getVariance(), whole.getVariance())
+        self.assertEqual(merged.getCount(), whole.getCount())
+        self.assertEqual(merged.getCureRate(), whole.getCureRate())
+        self.assertEqual((merged.minimum, merged.maximum),
+                         (whole.minimum, whole.maximum))
+        self.assertTrue(numpy.array_equal(merged.getHistogram()[0],
+                                          whole.getHistogram()[0]))
+
+    def testQuantileWithinOneBin(self):
+        rng = numpy.random.default_rng(2)
+        # a cured cluster near zero and a plateau near maxPop
+        values = numpy.concatenate((rng.poisson(5, 300),
+                                    rng.normal(500, 40, 700)))
+        edges = numpy.linspace(0, 1000, 51)
+        statistics = aggregate.CohortStatistics(edges)
+        statistics.add(values)
+        width = edges[1] - edges[0]
+        for quantile in (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99):
+            self.assertLessEqual(abs(statistics.getQuantile(quantile) -
+                                     numpy.quantile(values, quantile)),
+                                 width, msg=quantile)
+        self.assertEqual(statistics.getQuantile(0), values.min())
+        self.assertEqual(statistics.getQuantile(1), values.max())
+
+
+class ServiceTest(unittest.TestCase):
+    """
+    JobService must reject what it cannot serve before allocating anything,
+    and run accepted jobs exactly as cohort.runCohort() would.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = service.JobService(processes=1, maxPatients=20)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.service.close()
+
+    def _reject(self, spec):
+        with self.assertRaises(ValueError):
+            self.service.submitSpec(spec)
+
+    def testOversizedJob(self):
+        jobs = len(self.service.getJobs())
+        self._reject({'scenario': {'steps': 10}, 'patients': 1e12})
+        self._reject({'scenario': {'steps': 10}, 'patients': 21})
+        self.assertEqual(len(self.service.getJobs()), jobs)
+
+    def testMalformedScenario(self):
+        for scenario in ([300], 'steps', None,
+                         {'schedule': {}},
+                         {'steps': 10, 'schedule': 'guttagonol'},
+                         {'steps': 10, 'schedule': [[150]]},
+                         {'steps': 10, 'schedule': {'soon': ['guttagonol']}},
+                         {'steps': 10, 'schedule': {'150': 'guttagonol'}},
+                         {'steps': 10, 'engine': 'quantum'},
+                         {'steps': 10, 'engine': 3},
+                         {'steps': -1},
+                         {'steps': 10.5},
+                         {'steps': 10, 'maxBirthProb': 1.5},
+                         {'steps': 10, 'maxPop': True},
+                         {'steps': 10, 'earlyStop': 'yes'},
+                         {'steps': 10, 'drugs': 'guttagonol'},
+                         {'steps': 10, 'colour': 'red'}):
+            with self.assertRaises(ValueError, msg=repr(scenario)):
+                service.makeScenario(scenario)
+
+    def testMalformedJob(self):
+        scenario = {'steps': 10}
+        for spec in ({'patients': 5},
+                     {'scenario': scenario},
+                     {'scenario': scenario, 'patients': None},
+                     {'scenario': scenario, 'patients': 0},
+                     {'scenario': scenario, 'patients': 2.5},
+                     {'scenario': scenario, 'patients': '5'},
+                     {'scenario': scenario, 'patients': 5, 'seed': -1},
+                     {'scenario': scenario, 'patients': 5, 'client': 7},
+                     {'scenario': scenario, 'patients': 5, 'priority': 1}):
+            with self.assertRaises(ValueError, msg=repr(spec)):
+                self.service.submitSpec(spec)
+
+    def testBadRequest(self):
+        server = service.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             service.JobHandler)
+        server.service = self.service
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:%d/jobs' % server.server_address[1]
+            for body in (b'[1, 2]', b'not json',
+                         b'{"scenario": [], "patients": 5}',
+                         b'{"scenario": {"steps": 10}, "patients": null}'):
+                with self.assertRaises(urllib.error.HTTPError) as caught:
+                    urllib.request.urlopen(url, body, timeout=10)
+                self.assertEqual(caught.exception.code, 400)
+                self.assertIn('error', json.load(caught.exception))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def testMatchesRunCohort(self):
+        scenario = cohort.Scenario(30, engine='genotype')
+        job = self.service.submit(scenario, 12, seed=3)
+        list(self.service.events(job))
+        self.assertEqual(self.service.getSummary(job)['state'], 'done')
+        self.assertEqual(job.finalPops, cohort.runCohort(
+            scenario, 12, seed=3, processes=1).finalPops.tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
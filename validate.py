@@ -0,0 +1,269 @@
+"""
+Statistical equivalence harness for the patient engines.
+
+A faster engine is only a drop-in replacement for the object model in ps12
+(Patient with ResistantVirus particles) if it samples the same process. For a
+set of scenarios (the problem2, problem4 and problem6 setups plus randomly
+drawn parameters) this module simulates independent patients with the
+reference and a candidate engine, records the total and resistant populations
+at a number of checkpoint steps, and compares their distributions step by
+step with two-sample Kolmogorov-Smirnov tests. A case passes when no test
+rejects at the configured significance level after a Bonferroni correction
+over all of the case's tests. The wall time of both engines is reported too.
+
+    python validate.py --engine genotype --patients 200 --random 3
+"""
+
+import argparse
+import sys
+import time
+
+import numpy
+import scipy.stats
+
+import cohort
+import ps12
+
+
+CANDIDATES = sorted(set(cohort.ENGINES) - set(['object'])) + ['batch']
+
+
+class Case(object):
+    """
+    One validation scenario: an arm and the populations compared.
+    """
+
+    def __init__(self, name, scenario, resistances, checkpoints=10):
+        """
+        name: a label for reports (a string)
+
+        scenario: the arm to simulate (a cohort.Scenario); its engine is
+        ignored
+
+        resistances: the drug combinations whose resistant populations are
+        compared besides the total (a list of lists of strings)
+
+        checkpoints: at how many evenly spaced steps the distributions are
+        compared (an integer)
+        """
+        self.name = name
+        self.scenario = scenario
+        self.resistances = resistances
+        spaced = numpy.linspace(scenario.steps // checkpoints, scenario.steps,
+                                checkpoints)
+        self.steps = sorted(set(int(step) - 1 for step in spaced))
+
+    def withEngine(self, engine):
+        """
+        returns: a copy of the case's scenario simulated by engine (a string)
+        """
+        parameters = self.scenario.getParameters()
+        parameters['schedule'] = dict((step, drugs) for step, drugs
+                                      in parameters['schedule'])
+        parameters['engine'] = engine
+        return cohort.Scenario(**parameters)
+
+
+def standardCases():
+    """
+    returns: the problem2 (untreated), problem4 (guttagonol after 150 steps)
+    and problem6 (guttagonol after 150 steps, gimpex 75 steps later) setups
+    as Case instances
+    """
+    both = ['guttagonol', 'gimpex']
+    return [Case('problem2', cohort.Scenario(300, drugs=()), []),
+            Case('problem4', cohort.delayedTreatment(150), [['guttagonol']]),
+            Case('problem6', cohort.twoDrugTreatment(150, 75),
+                 [['guttagonol'], ['gimpex'], both])]
+
+
+def randomCases(number, seed=None):
+    """
+    Draws scenarios with random strain parameters, population sizes and
+    treatment delays, to exercise parameters the problem setups never use.
+
+    returns: a list of number Case instances
+    """
+    rng = numpy.random.default_rng(seed)
+    cases = []
+    for i in range(number):
+        firstDelay = int(rng.integers(0, 150))
+        secondDelay = int(rng.integers(0, 100))
+        scenario = cohort.twoDrugTreatment(
+            firstDelay, secondDelay,
+            maxBirthProb=float(rng.uniform(0.05, 0.3)),
+            clearProb=float(rng.uniform(0.02, 0.1)),
+            mutProb=float(rng.uniform(0.001, 0.05)),
+            maxPop=int(rng.integers(200, 2000)))
+        scenario.initialViruses = int(rng.integers(10, scenario.maxPop // 2))
+        cases.append(Case('random%d' % i, scenario,
+                          [['guttagonol'], ['gimpex'],
+                           ['guttagonol', 'gimpex']]))
+    return cases
+
+
+def _observe(patient, resistances):
+    """
+    returns: the total population followed by each resistant population (a
+    list of integers, or of arrays for a PatientBatch)
+    """
+    return [patient.getTotalPop()] + [patient.getResistPop(drugs)
+                                      for drugs in resistances]
+
+
+def _simulate(scenario, patient, steps, resistances):
+    """
+    Advances a patient through a scenario, observing it after each of the
+    given steps. Patients that can advance() several steps at once do so
+    between prescriptions and checkpoints, so their fast path is what gets
+    validated.
+
+    returns: the observations, indexed [checkpoint][quantity]
+    """
+    observations = []
+    stops = sorted(set(list(scenario.schedule) + [step + 1 for step in steps]))
+    step = 0
+    for stop in stops:
+        if stop > scenario.steps:
+            break
+        if hasattr(patient, 'advance'):
+            patient.advance(stop - step)
+        else:
+            for x in range(stop - step):
+                patient.update()
+        step = stop
+        if step - 1 in steps:
+            observations.append(_observe(patient, resistances))
+        for drug in scenario.schedule.get(step, ()):
+            patient.addPrescription(drug)
+    return observations
+
+
+def _runTrajectory(job):
+    """
+    Pool worker: simulates one patient of a case.
+
+    job: a (scenario, seedSequence, steps, resistances) tuple
+
+    returns: the observations (an array of checkpoints x quantities)
+    """
+    scenario, seedSequence, steps, resistances = job
+    patient = scenario.makePatient(numpy.random.default_rng(seedSequence))
+    return numpy.array(_simulate(scenario, patient, steps, resistances))
+
+
+def sampleCase(case, engine, numberOfPatients, seed=None, processes=None):
+    """
+    Simulates independent patients of a case with one engine.
+
+    engine: one of cohort.ENGINES, or 'batch' for a ps12.PatientBatch (a
+    string)
+
+    returns: a (samples, seconds) tuple, where samples is an array of
+    patients x checkpoints x quantities
+    """
+    entropy, seeds = cohort.patientSeeds(seed, numberOfPatients)
+    start = time.perf_counter()
+    if engine == 'batch':
+        scenario = case.withEngine('genotype')
+        batch = ps12.PatientBatch(scenario.makeViruses(), scenario.maxPop,
+                                  numberOfPatients,
+                                  rng=numpy.random.default_rng(seeds[0]))
+        observations = _simulate(scenario, batch, case.steps,
+                                 case.resistances)
+        samples = numpy.array(observations).transpose(2, 0, 1)
+    else:
+        scenario = case.withEngine(engine)
+        jobs = [(scenario, s, case.steps, case.resistances) for s in seeds]
+        samples = numpy.array(cohort._mapJobs(_runTrajectory, jobs,
+                                              processes))
+    return samples, time.perf_counter() - start
+
+
+def compareSamples(reference, candidate, alpha=0.01):
+    """
+    Runs one two-sample Kolmogorov-Smirnov test per checkpoint and quantity.
+    Populations are discrete, for which the asymptotic p-values of the test
+    are conservative.
+
+    reference, candidate: samples as returned by sampleCase()
+
+    alpha: the family-wise significance level (a float); each test rejects
+    at alpha divided by the number of tests
+
+    returns: a (passed, smallestPValue, threshold) tuple
+    """
+    tests = reference.shape[1] * reference.shape[2]
+    threshold = alpha / tests
+    smallest = 1.0
+    for i in range(reference.shape[1]):
+        for j in range(reference.shape[2]):
+            a = reference[:, i, j]
+            b = candidate[:, i, j]
+            if a.min() == a.max() == b.min() == b.max():
+                # e.g. every patient cleared in both samples
+                continue
+            pValue = scipy.stats.ks_2samp(a, b, method='asymp').pvalue
+            smallest = min(smallest, pValue)
+    return smallest >= threshold, smallest, threshold
+
+
+def validate(engine, cases, numberOfPatients=200, alpha=0.01, seed=0,
+             processes=None):
+    """
+    Validates a candidate engine against the object model on every case.
+
+    returns: a list of result dictionaries, one per case, with the keys
+    'case', 'passed', 'pValue', 'threshold', 'referenceSeconds',
+    'candidateSeconds' and 'speedup'
+    """
+    results = []
+    for i, case in enumerate(cases):
+        root = numpy.random.SeedSequence([seed, i])
+        referenceSeed, candidateSeed = [int(child.generate_state(1)[0])
+                                        for child in root.spawn(2)]
+        reference, referenceSeconds = sampleCase(
+            case, 'object', numberOfPatients, referenceSeed, processes)
+        candidate, candidateSeconds = sampleCase(
+            case, engine, numberOfPatients, candidateSeed, processes)
+        passed, pValue, threshold = compareSamples(reference, candidate,
+                                                   alpha)
+        results.append({'case': case.name,
+                        'passed': passed,
+                        'pValue': pValue,
+                        'threshold': threshold,
+                        'referenceSeconds': referenceSeconds,
+                        'candidateSeconds': candidateSeconds,
+                        'speedup': referenceSeconds / candidateSeconds})
+    return results
+
+
+def main(argv=None):
+    """
+    Command line entry point, see the module docstring.
+
+    returns: the process exit status (1 when a case failed)
+    """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--engine', choices=CANDIDATES, default='genotype')
+    parser.add_argument('--patients', type=int, default=200)
+    parser.add_argument('--alpha', type=float, default=0.01)
+    parser.add_argument('--random', type=int, default=2,
+                        help='number of randomly drawn scenarios')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args(argv)
+    cases = standardCases() + randomCases(args.random, args.seed)
+    results = validate(args.engine, cases, args.patients, args.alpha,
+                       args.seed, args.processes)
+    status = 0
+    for result in results:
+        print('%-10s %s  smallest p %.3g (threshold %.3g)  speedup %.1fx'
+              % (result['case'], 'PASS' if result['passed'] else 'FAIL',
+                 result['pValue'], result['threshold'], result['speedup']))
+        status = status or int(not result['passed'])
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())